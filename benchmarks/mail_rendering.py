@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Compare the rendering of the mails by registration.mails, which compiles the templates once
+per event, with the former mail functions of mailing.py, which resolved the translations,
+formatted the event and joined the urls for every mail.
+
+The registrations are not stored, the renderings don't need a database. Every message is
+rendered for the mail types of one event, with and without html alternative.
+
+    python benchmarks/mail_rendering.py [messages]
+"""
+import os
+import sys
+import time
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+django.setup()
+
+# needs to be after django.setup()
+from django.core.mail import EmailMessage
+from django.utils.translation import gettext_lazy as _
+
+from registration import mails
+from registration.models import Event, Subject
+from mysite import settings
+
+MESSAGES = 10000
+
+
+def legacy_message(sub):
+    subject = _('Registration for %s')
+    message = _('mail_body_%(name)s_%(event)s_%(hold_back_hours)i_%(confirm_url)s')
+
+    subject = subject%sub.event.title
+    message = message%dict(
+        name=sub.given_name,
+        event=sub.event,
+        hold_back_hours=sub.event.hold_back_hours,
+        confirm_url=os.path.join(settings.BASE_URL, sub.token, 'confirm'),
+        modify_url=os.path.join(settings.BASE_URL, sub.token, 'modify')
+    )
+    return EmailMessage(subject, message, settings.DEFAULT_FROM_EMAIL, [sub.email])
+
+
+def measure(render, subjects):
+    start = time.perf_counter()
+    for sub in subjects:
+        render(sub)
+    return time.perf_counter() - start
+
+
+def main():
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else MESSAGES
+    ev = Event(pk=1, title='Benchmark', num_total_seats=num)
+    subjects = [Subject(name='Name%i' % i, given_name='Given%i' % i, email='person%i@example.com' % i, event=ev)
+                for i in range(num)]
+
+    print('%-24s %10s %12s' % ('', 'time [s]', 'mails/s'))
+    runs = [('former mail functions', legacy_message, False),
+            ('precompiled', mails.confirmation_request_message, False),
+            ('precompiled with html', mails.confirmation_request_message, True)]
+    for name, render, html in runs:
+        settings.MAIL_HTML = html
+        mails._template.cache_clear()
+        duration = measure(render, subjects)
+        print('%-24s %10.3f %12.0f' % (name, duration, num / duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Compare render time and peak python memory of the participant list renderers, the LaTeX
+one (registration.sub_table_tex) and the html one (registration.sub_table_html).
+
+The subjects are generated on the fly and never stored, creating them is part of the
+measured time of both renderers. Time and memory are measured in separate runs, as
+tracemalloc slows down the rendering a lot. The LaTeX path is only measured if pdflatex
+is installed, its time includes the pdflatex run, the memory is that of the python
+process only.
+
+    python benchmarks/participant_list.py [rows ...]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+django.setup()
+
+# needs to be after django.setup()
+from registration import sub_table_html, sub_table_tex
+from registration.models import Event, Subject
+from mysite import settings
+
+ROWS = (1000, 10000, 50000)
+
+
+def subjects(ev, num):
+    for i in range(num):
+        yield Subject(name='Name%i' % i, given_name='Given%i' % i, email='person%i@example.com' % i,
+                      event=ev, num_seats=i % 5 + 1, status_confirmed=bool(i % 3))
+
+
+def measure(create_table, ev, num, out_path):
+    start = time.perf_counter()
+    create_table(ev, subjects(ev, num), out_path)
+    duration = time.perf_counter() - start
+
+    tracemalloc.start()
+    create_table(ev, subjects(ev, num), out_path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return duration, peak, os.path.getsize(out_path)
+
+
+def main():
+    rows = [int(n) for n in sys.argv[1:]] or ROWS
+    ev = Event(title='Benchmark', num_total_seats=max(rows) * 5)
+    renderers = [('html', sub_table_html.create_table, 'html')]
+    if shutil.which(settings.PDFLATEX):
+        renderers.insert(0, ('latex', sub_table_tex.create_table, 'pdf'))
+    else:
+        print('%s not found, skipping the LaTeX renderer' % settings.PDFLATEX)
+
+    print('%-6s %8s %10s %12s %12s' % ('', 'rows', 'time [s]', 'peak [MiB]', 'size [KiB]'))
+    with tempfile.TemporaryDirectory() as tmp:
+        for num in rows:
+            for name, create_table, ext in renderers:
+                duration, peak, size = measure(create_table, ev, num, os.path.join(tmp, 'list.' + ext))
+                print('%-6s %8i %10.3f %12.2f %12i' % (name, num, duration, peak / 2**20, size / 2**10))
+
+
+if __name__ == '__main__':
+    main()
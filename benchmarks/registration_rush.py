@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Simulate the opening rush of a registration. Synthetic registrants (names of the names
+package, reproducible with --seed) open the index page and register, then confirm their
+registration; a share of them modifies the number of seats, another one cancels. The
+registrants run concurrently, every request goes through the WSGI handler of the app
+in-process, without a web server.
+
+The run uses a fresh database created (and destroyed afterwards) like the one of the tests,
+with a single open event. The mailer is not running, the registrations only queue their
+wake-ups. Per endpoint, the throughput over the whole run, the p50/p95/p99 latencies and the
+number of queries per request are reported; --output writes them as json to compare runs.
+
+Requests answered with an unexpected status (ie 500, or 200 for a form with errors) are
+counted as errors by their status. With sqlite, all writes are serialized by the database
+lock; for numbers close to a deployment use PostgreSQL (DB_TYPE=postgres, see mysite/settings.py).
+
+    python benchmarks/registration_rush.py [--users 500] [--concurrency 20] [--output rush.json]
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from http.cookies import SimpleCookie
+from io import BytesIO
+from urllib.parse import urlencode
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+django.setup()
+
+# needs to be after django.setup()
+import names
+
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+from django.utils import timezone
+
+from registration.models import Event, Subject
+from mysite import settings
+from mysite.wsgi import application
+
+ENDPOINTS = ('index', 'create', 'confirm', 'modify', 'delete')
+CSRF_TOKEN = re.compile(r'name="csrfmiddlewaretoken" value="([^"]+)"')
+MAX_SEATS = 5
+
+
+def registrants(num, seed, modify, delete):
+    """
+        The registrants with their form data and what they do after confirming, the same for
+        the same seed
+    """
+    rnd = random.Random(seed)
+    # names picks the names with the random module
+    random.seed(seed)
+    for i in range(num):
+        given_name, name = names.get_full_name().split()
+        yield dict(
+            data=dict(name=name, given_name=given_name, email='%s.%s.%i@example.com' % (
+                given_name.lower(), name.lower(), i), num_seats=rnd.randint(1, MAX_SEATS),
+                # fields of the privacy notice and of SubjectExtended, ignored if not used
+                privacy='on', phone='0123456789', address='Street 1', post_code='12345', city='City'),
+            modify=rnd.random() < modify,
+            delete=rnd.random() < delete,
+        )
+
+
+class Recorder(object):
+    """
+        Latencies, query counts and errors of the requests per endpoint, shared by the threads
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int))
+
+    def record(self, endpoint, duration, queries, status, expected):
+        with self.lock:
+            self.latencies[endpoint].append(duration)
+            self.queries[endpoint].append(queries)
+            if status not in expected:
+                self.errors[endpoint]['status %i' % status] += 1
+
+
+class Browser(object):
+    """
+        The cookies of one registrant, its requests are passed to the WSGI application directly.
+        Unlike the test client, nothing is shared with the requests of the other threads.
+    """
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.cookies = SimpleCookie()
+
+    def environ(self, method, path, data):
+        body = urlencode(data or {}).encode()
+        return {
+            'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': '', 'SCRIPT_NAME': '',
+            'SERVER_NAME': 'testserver', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1',
+            'HTTP_HOST': 'testserver', 'REMOTE_ADDR': '127.0.0.1',
+            'HTTP_COOKIE': '; '.join('%s=%s' % (key, morsel.value) for key, morsel in self.cookies.items()),
+            'CONTENT_TYPE': 'application/x-www-form-urlencoded', 'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': BytesIO(body), 'wsgi.errors': sys.stderr, 'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http', 'wsgi.multithread': True, 'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+
+    def request(self, endpoint, method, path, data=None, expected=(200, 302)):
+        """
+            :return: the body of the response, None if its status is not expected
+        """
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split()[0])
+            for name, value in headers:
+                if name.lower() == 'set-cookie':
+                    self.cookies.load(value)
+
+        queries = []
+
+        def count(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        with connection.execute_wrapper(count):
+            result = application(self.environ(method, path, data), start_response)
+            try:
+                body = b''.join(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        duration = time.perf_counter() - start
+        self.recorder.record(endpoint, duration, len(queries), response['status'], expected)
+        return body.decode() if response['status'] in expected else None
+
+    def csrf_token(self, page):
+        match = CSRF_TOKEN.search(page)
+        return match.group(1) if match else ''
+
+
+def registrant(recorder, ev, reg):
+    browser = Browser(recorder)
+    try:
+        page = browser.request('index', 'GET', reverse('index'))
+        data = dict(reg['data'], event=ev.pk, csrfmiddlewaretoken=browser.csrf_token(page or ''))
+        # redirected to the submitted page, a form with errors (e.g. booked out) is an error
+        if browser.request('create', 'POST', reverse('index'), data, expected=(302,)) is None:
+            return
+        # the token is in the mail, which isn't sent
+        token = Subject.objects.filter(event=ev, email=data['email']).values_list('token', flat=True).first()
+        browser.request('confirm', 'GET', reverse('subject-confirm', args=[token]))
+        if reg['modify']:
+            data['num_seats'] = data['num_seats'] % MAX_SEATS + 1
+            browser.request('modify', 'POST', reverse('subject-modify', args=[token]), data, expected=(302,))
+        if reg['delete']:
+            browser.request('delete', 'POST', reverse('subject-delete', args=[token]),
+                            dict(csrfmiddlewaretoken=data['csrfmiddlewaretoken']), expected=(302,))
+    finally:
+        # the thread is reused for the next registrant
+        connection.close()
+
+
+def percentile(values, p):
+    # nearest rank
+    values = sorted(values)
+    return values[max(0, int(round(p / 100 * len(values))) - 1)] if values else None
+
+
+def summary(recorder, duration):
+    result = {}
+    for endpoint in ENDPOINTS:
+        latencies = recorder.latencies.get(endpoint, [])
+        if not latencies:
+            continue
+        queries = recorder.queries[endpoint]
+        result[endpoint] = dict(
+            requests=len(latencies),
+            errors=sum(recorder.errors[endpoint].values()),
+            error_types=dict(recorder.errors[endpoint]),
+            throughput=len(latencies) / duration,
+            p50=percentile(latencies, 50),
+            p95=percentile(latencies, 95),
+            p99=percentile(latencies, 99),
+            queries_mean=sum(queries) / len(queries),
+            queries_max=max(queries),
+        )
+    return result
+
+
+def run(users, concurrency, seed, modify, delete):
+    ev = Event.objects.create(
+        title='Rush', num_total_seats=users * MAX_SEATS, num_max_per_subject=MAX_SEATS,
+        enable_on=timezone.now() - timedelta(days=1),
+        disable_on=timezone.now() + timedelta(days=1))
+    regs = list(registrants(users, seed, modify, delete))
+    # the threads use connections of their own
+    connection.close()
+
+    recorder = Recorder()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(registrant, recorder, ev, reg) for reg in regs]:
+            future.result()
+    duration = time.perf_counter() - start
+    return duration, summary(recorder, duration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate the opening rush of a registration')
+    parser.add_argument('--users', type=int, default=500, help='number of registrants, default: 500')
+    parser.add_argument('--concurrency', type=int, default=20,
+                        help='registrants at the same time, default: 20')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the registrants, default: 0')
+    parser.add_argument('--modify', type=float, default=.3,
+                        help='share of the registrants modifying their registration, default: 0.3')
+    parser.add_argument('--delete', type=float, default=.1,
+                        help='share of the registrants cancelling their registration, default: 0.1')
+    parser.add_argument('--output', help='write the results as json to this file')
+    args = parser.parse_args()
+
+    # the failed requests are counted by their status, not logged
+    logging.getLogger('django.request').setLevel(logging.CRITICAL)
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            settings.MAIL_WAKEUP_FILE = os.path.join(tmp, 'mailing.wakeup')
+            duration, endpoints = run(args.users, args.concurrency, args.seed, args.modify, args.delete)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+    print('%d registrants, %d at the same time, %s: %.2f s' % (
+        args.users, args.concurrency, connection.vendor, duration))
+    print('%-8s %8s %7s %8s %9s %9s %9s %8s' % (
+        '', 'requests', 'errors', 'req/s', 'p50 [ms]', 'p95 [ms]', 'p99 [ms]', 'queries'))
+    for endpoint, r in endpoints.items():
+        print('%-8s %8i %7i %8.1f %9.1f %9.1f %9.1f %8.1f' % (
+            endpoint, r['requests'], r['errors'], r['throughput'],
+            1000 * r['p50'], 1000 * r['p95'], 1000 * r['p99'], r['queries_mean']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(
+                config=dict(vars(args), database=connection.vendor, django=django.get_version(),
+                            python=platform.python_version()),
+                duration=duration,
+                endpoints=endpoints,
+            ), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
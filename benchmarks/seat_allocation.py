@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Compare the seat allocation of registration.seating.SeatMap with the former assign_seats,
+which collected the taken seats in a list and tested every seat number against it.
+
+Every hall is filled in booking order up to 90% with groups of 1-5 seats, then the time to
+book 3 more seats is measured, once for the hall as it is filled and once after 2% of the
+bookings have been cancelled. The former function starts from the comma separated seat
+strings it used to read from the database, the SeatMap from the seat numbers as they are
+returned by the query on SeatAssignment.
+
+    python benchmarks/seat_allocation.py
+"""
+import os
+import random
+import sys
+import timeit
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+django.setup()
+
+# needs to be after django.setup()
+from registration.seating import SeatMap
+
+HALL_SIZES = (500, 5000, 50000)
+NUM_SEATS = 3
+
+
+def legacy_allocate(num_total_seats, seat_strings, num_seats):
+    taken, seats = [], []
+    for s in seat_strings:
+        taken.extend(map(int, s.split(',')))
+    # seat numbers start at 1
+    for i in range(1, num_total_seats+1):
+        if i not in taken: seats.append(i)
+        if len(seats) == num_seats:
+            break
+    return seats
+
+
+def seat_map_allocate(num_total_seats, seat_numbers, num_seats):
+    # same as SeatMap.for_event() without the query
+    return SeatMap(num_total_seats, seat_numbers).allocate(num_seats)
+
+
+def fill(num_total_seats, rnd):
+    bookings, seat = [], 1
+    while seat < num_total_seats * .9:
+        n = rnd.randint(1, 5)
+        bookings.append(','.join(map(str, range(seat, seat+n))))
+        seat += n
+    return bookings
+
+
+def cancel(bookings, rnd):
+    cancelled = set(rnd.sample(range(len(bookings)), len(bookings) // 50))
+    return [b for i, b in enumerate(bookings) if i not in cancelled]
+
+
+def measure(func, size, bookings):
+    number, total = 0, 0
+    # repeat for at least 0.2s
+    while total < .2:
+        total += timeit.timeit(lambda: func(size, bookings, NUM_SEATS), number=1)
+        number += 1
+    return total / number
+
+
+def main():
+    rnd = random.Random(42)
+    print('%-10s %8s %10s %14s %14s %9s' % (
+        'hall', 'seats', 'bookings', 'legacy [ms]', 'seatmap [ms]', 'speedup'))
+    for size in HALL_SIZES:
+        filled = fill(size, rnd)
+        for name, bookings in (('filled', filled), ('cancelled', cancel(filled, rnd))):
+            seat_numbers = [int(s) for b in bookings for s in b.split(',')]
+            legacy = measure(legacy_allocate, size, bookings)
+            seat_map = measure(seat_map_allocate, size, seat_numbers)
+            print('%-10s %8i %10i %14.3f %14.3f %8.1fx' % (
+                name, size, len(bookings), legacy * 1e3, seat_map * 1e3, legacy / seat_map))
+
+
+if __name__ == '__main__':
+    main()
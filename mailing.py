@@ -1,172 +1,340 @@
 import os
 import time
+import fcntl
+import asyncio
+import argparse
+import socket
+import threading
 import django
 
+from asgiref.sync import sync_to_async
+from contextlib import contextmanager
+
 from datetime import timedelta
 
 from django.utils import timezone
-from django.core.mail import send_mail
-from django.utils.translation import gettext_lazy as _, ngettext, ngettext_lazy
+from django.core.mail import get_connection
+from django.db import connection, transaction, OperationalError
 from django.db.models import Q
 
 os.environ['DJANGO_SETTINGS_MODULE'] = 'mysite.settings'
 django.setup()
 
 # needs to be after django.setup()
-from registration.models import Subject
-from mysite.settings import DEFAULT_FROM_EMAIL, BASE_URL
+from registration.expiry import expire_registrations
+from registration.mails import confirmation_request_message, remainder_message, confirmation_message, \
+    cancellation_message, outbox_message, outbox_email
+from registration.models import Subject, OutboxMessage, lock_rows
+from registration.ratelimit import RelayPool
+from registration.wakeup import Waiter
+from mysite.settings import MAIL_BATCH_SIZE, MAIL_RELAYS, \
+    MAIL_CLAIM_SECONDS, MAIL_LOCK_FILE, MAIL_MAX_ATTEMPTS, MAIL_RETRY_DELAY, MAIL_OUTBOX_KEEP_DAYS, \
+    MAIL_SESSIONS
+
+# the mail servers to send with, their rate limits are shared by all kinds of mails
+relays = RelayPool(MAIL_RELAYS)
 
-# intervall for checking for new mails to be send
-INTERVAL = 30
-# deadtime after a mail has been sent (mail server has 10 Mails/minute restriction)
-DEADTIME = 10
-confirm_url = lambda base, token: os.path.join(base, token, 'confirm')
-modify_url = lambda base, token: os.path.join(base, token, 'modify')
+class RelayUnavailable(Exception):
+    pass
 
-def do_send_mail(subject, message, to):
+def send_messages(messages):
+    """
+        Send the messages over the relays, using one connection per relay
+        :return: list with None for every message that was sent, the exception if it failed;
+            RelayUnavailable for the messages not tried as a relay was not reachable
+    """
+    connections = {}
+    errors = []
     try:
-        send_mail(subject, message, DEFAULT_FROM_EMAIL, [to])
-        time.sleep(DEADTIME)
-        return True        
-    except Exception as e:
-        print(e)
-        return False    
+        for message in messages:
+            relay = relays.acquire()
+            if relay.name not in connections:
+                connections[relay.name] = get_connection(**relay.options)
+            connection = connections[relay.name]
+            try:
+                connection.open()
+            except Exception as e:
+                print('unable to connect to %s: %s'%(relay, e))
+                errors += [RelayUnavailable('%s: %s'%(relay, e))]*(len(messages) - len(errors))
+                ## nothing was sent, the token stays available
+                relay.bucket.give_back()
+                break
+            try:
+                connection.send_messages([message])
+                errors.append(None)
+            except Exception as e:
+                print('%s: %s'%(', '.join(message.to), e))
+                errors.append(e)
+                # the connection might be broken, it is reopened for the next message
+                connection.close()
+    finally:
+        for connection in connections.values():
+            connection.close()
+    return errors
+
+def do_send_mail(message):
+    return send_messages([message])[0] is None
 
-## send when the subject registers for the event,
-## contains the link for the registration confirmation
 def confirmation_request_mail(sub):
-    subject = _('Registration for %s')
-    message = _('mail_body_%(name)s_%(event)s_%(hold_back_hours)i_%(confirm_url)s')
-
-    subject = subject%sub.event.title
-    message = message%dict(
-        name=sub.given_name,
-        event=sub.event,
-        hold_back_hours=sub.event.hold_back_hours,
-        confirm_url=confirm_url(BASE_URL, sub.token),
-        modify_url=modify_url(BASE_URL, sub.token)
-    )
-    return do_send_mail(subject, message, sub.email)
-
-## send after some timeout to warn about registration deletion
+    return do_send_mail(confirmation_request_message(sub))
+
 def remainder_mail(sub):
-    subject = _('Reminder of registration for %s')
-    message = _('reminder_body_%(name)s_%(event)s_%(cancel_hours)i_%(confirm_url)s_%(modify_url)s')
-
-    subject = subject%sub.event.title
-    message = message%dict(
-        name=sub.given_name,
-        event=sub.event,
-        cancel_hours=sub.event.hold_back_hours - sub.event.reminder_hours,
-        confirm_url=confirm_url(BASE_URL, sub.token),
-        modify_url=modify_url(BASE_URL, sub.token)
-    )
-    return do_send_mail(subject, message, sub.email)
-
-## send when the subject clicked on the registration confirmation link
+    return do_send_mail(remainder_message(sub))
+
 def confirmation_mail(sub):
-    subject = _('Confirmed registration for %s')
-    message = _('confirmation_body_%(name)s_%(event)s_%(modify_url)s_%(seats)s')
-
-    seats = ''
-    if sub.event.assigned_seats:
-        seats = _(ngettext_lazy(
-            'subject_seats_%(seat_nums)s',
-            'subject_seats_pl_%(seat_nums)s',
-            sub.num_seats))%dict(seat_nums=sub.seats)
-        seats += '\n(Plan: %s/static/registration/GHS_physik.pdf)\n'%BASE_URL
-
-    subject = subject%sub.event.title
-    message = message%dict(
-        name=sub.given_name,
-        event=sub.event,
-        seats=seats,
-        modify_url=modify_url(BASE_URL, sub.token),
-    )
-    return do_send_mail(subject, message, sub.email)
+    return do_send_mail(confirmation_message(sub))
 
 def cancellation_mail(sub):
-    subject = _('Cancellation of registration for %s')
-    message = _('cancellation_body_%(name)s_%(event)s')
+    return do_send_mail(cancellation_message(sub))
 
-    subject = subject%sub.event.title
-    message = message%dict(
-        name=sub.given_name,
-        event=sub.event,
-    )    
-    return do_send_mail(subject, message, sub.email)
+def worker_id():
+    # claims are owned by a thread of a mailer process
+    return '%s:%i:%i'%(socket.gethostname(), os.getpid(), threading.get_ident())
 
-def next_subject(query):
-    try:
-        sub = Subject.objects \
-            .filter(query) \
-            .order_by('reg_date')[0]
-        return sub
-    except:
-        return None
+def claim(model, query, order_by):
+    """
+        Claim the next batch of objects matching the query for this worker. The claim expires after
+        MAIL_CLAIM_SECONDS, so that the work of a crashed worker is done by others.
+    """
+    now = timezone.now()
+    worker, until = worker_id(), now + timedelta(seconds=MAIL_CLAIM_SECONDS)
+    claimed_by, claimed_until = model.CLAIM_FIELDS
+    free = Q(**{claimed_until+'__isnull': True}) | Q(**{claimed_until+'__lt': now})
+    with transaction.atomic():
+        objs = model.objects.filter(query).filter(free).order_by(order_by, 'pk')
+        if connection.features.has_select_for_update_skip_locked:
+            # skip the rows other workers are claiming right now instead of waiting for them
+            pks = list(objs.select_for_update(skip_locked=True).values_list('pk', flat=True)[:MAIL_BATCH_SIZE])
+            # the conditions are repeated, only objects that are still free are claimed
+            model.objects.filter(query, free, pk__in=pks).update(**{claimed_by: worker, claimed_until: until})
+        else:
+            # write first, on sqlite a read before the write fails instead of waiting for other writers
+            model.objects.filter(pk__in=objs.values('pk')[:MAIL_BATCH_SIZE]) \
+                .update(**{claimed_by: worker, claimed_until: until})
+            pks = list(model.objects.filter(query, **{claimed_by: worker, claimed_until: until})
+                       .values_list('pk', flat=True))
+    return model.objects.filter(pk__in=pks, **{claimed_by: worker, claimed_until: until}).order_by(order_by, 'pk')
 
-def handle_new_subjects():
+def release(model, pks):
+    claimed_by, claimed_until = model.CLAIM_FIELDS
+    model.objects.filter(pk__in=pks, **{claimed_by: worker_id()}).update(**{claimed_by: '', claimed_until: None})
+
+def handle_subjects(query, kind, message, done, order_by='reg_date'):
+    """
+        Put a message to all subjects matching the query into the outbox, in batches. done(pks) is
+        called with the subjects of a batch in the same transaction.
+    """
     while True:
-        sub = next_subject(Q(confirmation_request_sent=False))
-        if sub is None: return True
-        if not confirmation_request_mail(sub): break
-        sub.confirmation_request_sent = True
-        sub.save()        
-    return False
+        subs = list(claim(Subject, query, order_by).select_related('event').prefetch_related('seat_assignments'))
+        if len(subs) == 0: return
+        with transaction.atomic():
+            # skip subjects that changed since they were claimed, ie confirmed while waiting for the reminder
+            claimed = Subject.objects.filter(query, pk__in=[sub.pk for sub in subs])
+            current = set(lock_rows(claimed, 'mail_claimed_by').values_list('pk', flat=True))
+            OutboxMessage.objects.bulk_create(
+                [outbox_message(kind, sub, message(sub)) for sub in subs if sub.pk in current])
+            done(list(current))
+        release(Subject, [sub.pk for sub in subs if sub.pk not in current])
+
+def set_flag(query, flag):
+    return lambda pks: Subject.objects.filter(query, pk__in=pks) \
+        .update(mail_claimed_by='', mail_claimed_until=None, **{flag: True})
+
+def handle_new_subjects():
+    query = Q(confirmation_request_sent=False)
+    handle_subjects(query, 'confirmation_request', confirmation_request_message,
+                    set_flag(query, 'confirmation_request_sent'))
 
 def handle_confirmed_subjects():
-    while True:
-        sub = next_subject(Q(status_confirmed=True) & Q(confirmation_sent=False))
-        if sub is None: return True
-        if not confirmation_mail(sub): break
-        sub.confirmation_sent = True
-        sub.save()        
-    return False
+    query = Q(status_confirmed=True, confirmation_sent=False)
+    handle_subjects(query, 'confirmation', confirmation_message, set_flag(query, 'confirmation_sent'))
 
 def handle_pending_subjects():
-    while True:
-        # fetch new list of pending subjects
-        subs = Subject.objects \
-            .filter(confirmation_request_sent=True, status_confirmed=False) \
-            .order_by('reg_date')
-
-        # nothing to do anymore, so return
-        if len(subs) == 0: return True
-
-        # iterate over possible subject until one is found where email has to be send. Then
-        # start all over to minimize risk that s.t. has changed in the DB in the meantime
-        mail_sent=False
-        for sub in subs:
-            if not sub.reminder_sent:
-                # check, how long ago the request was send... send remainder (once) if certain timeout hit
-                if timezone.now() > sub.reg_date + timedelta(hours=sub.event.reminder_hours):
-                    if not remainder_mail(sub): return False
-                    sub.reminder_sent = True
-                    sub.save()                    
-                    mail_sent=True
-                    break
+    # send the remainder (once), registrations not confirmed afterwards expire
+    pending = Q(confirmation_request_sent=True, status_confirmed=False)
+    reminders = pending & Q(reminder_sent=False, reminder_due_at__lte=timezone.now())
+    handle_subjects(reminders, 'reminder', remainder_message, set_flag(reminders, 'reminder_sent'),
+                    order_by='reminder_due_at')
+    expire_registrations()
+
+def claim_due_messages():
+    due_messages = Q(status=OutboxMessage.PENDING, next_attempt__lte=timezone.now())
+    return list(claim(OutboxMessage, due_messages, 'next_attempt'))
+
+def record_results(msgs, errors):
+    """
+        Store the outcome of sending the outbox messages, the errors as returned by send_messages()
+        :return: False if a relay is not available
+    """
+    now = timezone.now()
+    for msg, error in zip(msgs, errors):
+        msg.claimed_by, msg.claimed_until = '', None
+        if error is None:
+            msg.status, msg.sent = OutboxMessage.SENT, now
+            msg.attempts += 1
+        # not the fault of the message, doesn't count as attempt
+        elif not isinstance(error, RelayUnavailable):
+            msg.attempts += 1
+            msg.last_error = str(error)
+            if msg.attempts >= MAIL_MAX_ATTEMPTS:
+                msg.status = OutboxMessage.DEAD
             else:
-                if timezone.now() > sub.reg_date + timedelta(hours=sub.event.hold_back_hours): 
-                    if not cancellation_mail(sub): return False
-                    sub.delete()
-                    mail_sent=True
-                    break
+                msg.next_attempt = now + timedelta(seconds=MAIL_RETRY_DELAY * 2**(msg.attempts-1))
+    OutboxMessage.objects.bulk_update(
+        msgs, ['status', 'sent', 'attempts', 'last_error', 'next_attempt', 'claimed_by', 'claimed_until'])
+    return not any(isinstance(error, RelayUnavailable) for error in errors)
 
-        # nothing to do for matching subjects
-        if not mail_sent:
-            return True
+def drain_outbox():
+    """
+        Send the due messages of the outbox. Failed messages are retried with exponential backoff,
+        after MAIL_MAX_ATTEMPTS they are dead.
+        :return: False if a relay is not available
+    """
+    while True:
+        msgs = claim_due_messages()
+        if len(msgs) == 0: return True
+        errors = send_messages([outbox_email(msg) for msg in msgs])
+        if not record_results(msgs, errors): return False
+
+## asyncio mode, the mails are sent over several connections at the same time;
+## the database is used from sync_to_async, the smtp connections from threads
+async def acquire_relay():
+    while True:
+        relay, wait = await sync_to_async(relays.try_acquire)()
+        if relay is not None:
+            return relay
+        await asyncio.sleep(wait)
+
+async def send_messages_async(messages, sessions):
+    """
+        Send the messages over up to sessions connections at the same time
+        :return: like send_messages()
+    """
+    in_thread = lambda func, *args: sync_to_async(func, thread_sensitive=False)(*args)
+    queue = asyncio.Queue()
+    for i, message in enumerate(messages):
+        queue.put_nowait((i, message))
+    # messages left over as no relay was reachable keep the error
+    errors = [RelayUnavailable('not sent')]*len(messages)
+
+    async def session():
+        connections = {}
+        try:
+            while not queue.empty():
+                i, message = queue.get_nowait()
+                relay = await acquire_relay()
+                if relay.name not in connections:
+                    connections[relay.name] = get_connection(**relay.options)
+                connection = connections[relay.name]
+                try:
+                    await in_thread(connection.open)
+                except Exception as e:
+                    print('unable to connect to %s: %s'%(relay, e))
+                    errors[i] = RelayUnavailable('%s: %s'%(relay, e))
+                    ## nothing was sent, the token stays available
+                    await sync_to_async(relay.bucket.give_back)()
+                    return
+                try:
+                    await in_thread(connection.send_messages, [message])
+                    errors[i] = None
+                except Exception as e:
+                    print('%s: %s'%(', '.join(message.to), e))
+                    errors[i] = e
+                    await in_thread(connection.close)
+        finally:
+            for connection in connections.values():
+                await in_thread(connection.close)
+
+    await asyncio.gather(*[session() for i in range(min(sessions, len(messages)))])
+    return errors
+
+async def drain_outbox_async(sessions=MAIL_SESSIONS):
+    """
+        Like drain_outbox(), sending over up to sessions connections at the same time
+    """
+    while True:
+        msgs = await sync_to_async(claim_due_messages)()
+        if len(msgs) == 0: return True
+        errors = await send_messages_async([outbox_email(msg) for msg in msgs], sessions)
+        if not await sync_to_async(record_results)(msgs, errors): return False
+
+def purge_outbox():
+    OutboxMessage.objects.filter(
+        status=OutboxMessage.SENT, sent__lt=timezone.now() - timedelta(days=MAIL_OUTBOX_KEEP_DAYS)).delete()
+
+@contextmanager
+def worker_lock():
+    """
+        Several workers can run in parallel if the database supports SELECT ... FOR UPDATE SKIP LOCKED.
+        Otherwise (sqlite) only one of them runs a cycle at a time, the others wait for it.
+    """
+    if connection.features.has_select_for_update_skip_locked:
+        yield
+        return
+    os.makedirs(os.path.dirname(MAIL_LOCK_FILE), exist_ok=True)
+    with open(MAIL_LOCK_FILE, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+def enqueue_due_mails():
+    handle_new_subjects()
+    handle_pending_subjects()
+    handle_confirmed_subjects()
 
 def mailer():
-    if not handle_new_subjects(): return
-    if not handle_pending_subjects(): return
-    if not handle_confirmed_subjects(): return
+    with worker_lock():
+        enqueue_due_mails()
+        drain_outbox()
+        purge_outbox()
 
-if __name__ == "__main__":
+async def mailer_async(sessions=MAIL_SESSIONS):
+    ## the lock is waited for in a thread, the event loop keeps running meanwhile
+    lock = worker_lock()
+    await sync_to_async(lock.__enter__)()
     try:
-        while True:
+        await sync_to_async(enqueue_due_mails)()
+        await drain_outbox_async(sessions)
+        await sync_to_async(purge_outbox)()
+    finally:
+        await sync_to_async(lock.__exit__)(None, None, None)
+
+def run(stop=None):
+    """
+        Run mailer cycles until the stop event is set, waiting for wake ups in between
+    """
+    waiter = Waiter()
+    while stop is None or not stop.is_set():
+        try:
             mailer()
-            time.sleep(INTERVAL)
+        except OperationalError as e:
+            # ie the database is locked or the connection was lost, the next cycle tries again
+            print('mailer cycle failed: %s'%e)
+            connection.close()
+        waiter.wait()
+
+async def run_async(sessions=MAIL_SESSIONS, stop=None):
+    waiter = Waiter()
+    while stop is None or not stop.is_set():
+        try:
+            await mailer_async(sessions)
+        except OperationalError as e:
+            print('mailer cycle failed: %s'%e)
+            await sync_to_async(lambda: connection.close())()
+        await sync_to_async(waiter.wait)()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Send the mails of the registrations')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='send over several connections at the same time, using asyncio')
+    parser.add_argument('--sessions', type=int, default=MAIL_SESSIONS,
+                        help='number of connections of the asyncio mode, default: MAIL_SESSIONS')
+    args = parser.parse_args()
+    try:
+        if args.use_async:
+            asyncio.run(run_async(args.sessions))
+        else:
+            run()
     except (KeyboardInterrupt, SystemExit):
         print("Exiting")
     except Exception as e:
-        raise e
\ No newline at end of file
+        raise e
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/2.2/ref/settings/
 
 import os
 import json
+import tempfile
 from django.utils.translation import gettext_lazy as _
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -51,6 +52,59 @@ PRIVACY_NOTICE = False
 # Data to store during registration: 'SubjectBase' or 'SubjectExtended', see models.py
 SUBJECT_CLASS = 'SubjectBase'
 
+# seconds the snapshot of the open events is kept in the django cache (see CACHES)
+EVENTS_CACHE_TIMEOUT = 10
+# seconds each process reuses its copy of the snapshot before looking at the django cache again
+EVENTS_CACHE_LOCAL_TIMEOUT = 1
+
+# directory for the generated participant lists
+EXPORT_ROOT = os.path.join(BASE_DIR, '.build', 'exports')
+# number of background threads per process building participant lists
+EXPORT_WORKERS = 1
+# seconds after which an unfinished export is considered lost, ie because its process died
+EXPORT_STALE_SECONDS = 600
+# how participant lists are rendered: 'latex' creates a pdf with pdflatex, 'html' a printable
+# html page without the need for a TeX installation
+PARTICIPANT_LIST_RENDERER = 'latex'
+# pdflatex executable, maximum number of pdflatex processes per process and their timeout in seconds
+PDFLATEX = 'pdflatex'
+PDFLATEX_MAX_PROCESSES = 2
+PDFLATEX_TIMEOUT = 120
+
+# number of mails the mailer sends over one connection to the mail server
+MAIL_BATCH_SIZE = 50
+# seconds a mailer worker owns the subjects of a batch, has to be longer than sending a batch
+# takes with the rate limits of MAIL_RELAYS; afterwards other workers take over
+MAIL_CLAIM_SECONDS = 900
+# with sqlite, only one mailer worker at a time can run, they coordinate with this file
+MAIL_LOCK_FILE = os.path.join(BASE_DIR, '.build', 'mailing.lock')
+# failed mails are retried after MAIL_RETRY_DELAY seconds, doubled on every attempt; after
+# MAIL_MAX_ATTEMPTS they are marked dead and can be retried in the admin
+MAIL_MAX_ATTEMPTS = 8
+MAIL_RETRY_DELAY = 60
+# days sent mails are kept in the outbox
+MAIL_OUTBOX_KEEP_DAYS = 30
+# registrations and confirmations wake up the mailer right away, besides that it looks for due
+# mails every MAIL_POLL_MIN seconds, backing off to MAIL_POLL_MAX seconds while there is nothing to do
+MAIL_POLL_MIN = 1
+MAIL_POLL_MAX = 60
+# without PostgreSQL (LISTEN/NOTIFY), the mailer is woken up by touching this file
+MAIL_WAKEUP_FILE = os.path.join(BASE_DIR, '.build', 'mailing.wakeup')
+# number of connections sending at the same time in the asyncio mode of the mailer (mailing.py --async)
+MAIL_SESSIONS = 4
+# send the mails with an html alternative of the text
+MAIL_HTML = False
+# number of expired registrations deleted per transaction
+EXPIRY_CHUNK_SIZE = 500
+# rows per page of the subject list of the admin
+SUBJECTS_PER_PAGE = 50
+# mail servers used by the mailer in round-robin, each allows rate mails per interval seconds
+# and bursts of up to burst mails. The remaining keys are passed to the email backend (host,
+# port, username, password, use_tls, ...), without them the EMAIL_* settings are used.
+MAIL_RELAYS = [
+    {'name': 'default', 'rate': 10, 'interval': 60, 'burst': 1},
+]
+
 try:
     from mysite.local_settings import *
 except ImportError:
@@ -102,6 +156,11 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# measure every request: Server-Timing headers and histograms per url name at /timing (staff only)
+REQUEST_TIMING = os.getenv('REQUEST_TIMING', 'False').lower() == 'true'
+if REQUEST_TIMING:
+    MIDDLEWARE.insert(0, 'mysite.timing.request_timing_middleware')
+
 ROOT_URLCONF = 'mysite.urls'
 
 TEMPLATES = [
@@ -144,6 +203,9 @@ else:
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+            # the in-memory test database uses table locks that fail instead of waiting,
+            # which breaks the tests running concurrent requests
+            'TEST': {'NAME': os.path.join(tempfile.gettempdir(), 'registration_test_db.sqlite3')},
         }
     }
 
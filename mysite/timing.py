@@ -0,0 +1,114 @@
+import threading
+import time
+
+from contextlib import ExitStack
+
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db import connections
+from django.http import JsonResponse
+from django.template.base import Template
+
+# upper bounds of the buckets of the histograms, in ms
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+
+_lock = threading.Lock()
+_local = threading.local()
+# per url name, counters of this process only
+stats = {}
+
+
+def _instrument_templates():
+    # time the outermost render of a template, the included and extended ones are part of it
+    if getattr(Template._render, 'timed', False):
+        return
+    render = Template._render
+
+    def timed_render(self, context):
+        timing = getattr(_local, 'timing', None)
+        if timing is None or timing['template_depth'] > 0:
+            return render(self, context)
+        timing['template_depth'] += 1
+        start, db = time.perf_counter(), timing['db']
+        try:
+            return render(self, context)
+        finally:
+            # the lazy querysets evaluated by the template are counted in db only
+            timing['template'] += time.perf_counter() - start - (timing['db'] - db)
+            timing['template_depth'] -= 1
+
+    timed_render.timed = True
+    Template._render = timed_render
+
+
+def _record(name, total, timing, size):
+    with _lock:
+        entry = stats.get(name)
+        if entry is None:
+            entry = stats[name] = dict(requests=0, total=0.0, db=0.0, queries=0, template=0.0, size=0,
+                                       histogram=[0] * len(BUCKETS))
+        entry['requests'] += 1
+        entry['total'] += total
+        entry['db'] += timing['db']
+        entry['queries'] += timing['queries']
+        entry['template'] += timing['template']
+        entry['size'] += size
+        ms = 1000 * total
+        entry['histogram'][next(i for i, bound in enumerate(BUCKETS) if ms <= bound)] += 1
+
+
+def request_timing_middleware(get_response):
+    """
+        Measure the wall time, the number and time of the db queries, the time to render the
+        templates without the queries run by them and the size of the response of every request.
+        They are sent in the Server-Timing header and aggregated per url name in stats, see
+        timing_stats().
+
+        Enabled with REQUEST_TIMING, installed first to include the other middleware. Only the
+        templates of the Django backend are timed, the render of other backends is not patched.
+    """
+    _instrument_templates()
+
+    def query_wrapper(execute, sql, params, many, context):
+        timing = getattr(_local, 'timing', None)
+        if timing is None:
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            timing['db'] += time.perf_counter() - start
+            timing['queries'] += 1
+
+    def middleware(request):
+        timing = _local.timing = dict(db=0.0, queries=0, template=0.0, template_depth=0)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(query_wrapper))
+                response = get_response(request)
+        finally:
+            _local.timing = None
+        total = time.perf_counter() - start
+
+        # the content of streaming responses is produced after the middleware
+        size = 0 if response.streaming else len(response.content)
+        response['Server-Timing'] = 'total;dur=%.1f, db;dur=%.1f;desc="%i queries", tpl;dur=%.1f' % (
+            1000 * total, 1000 * timing['db'], timing['queries'], 1000 * timing['template'])
+        match = getattr(request, 'resolver_match', None)
+        _record(match.url_name if match is not None and match.url_name else 'unresolved', total, timing, size)
+        return response
+
+    return middleware
+
+
+@staff_member_required
+def timing_stats(request):
+    # counters of this process only, times in ms
+    with _lock:
+        result = {name: dict(entry, histogram=dict(zip(map(str, BUCKETS), entry['histogram'])))
+                  for name, entry in stats.items()}
+    for entry in result.values():
+        for key in ('total', 'db', 'template'):
+            entry[key] = round(1000 * entry[key], 3)
+    return JsonResponse(result)
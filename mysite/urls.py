@@ -16,8 +16,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import include, path
 
+from mysite.timing import timing_stats
+
 urlpatterns = [
     path('', include('registration.urls')),
     path('admin/', admin.site.urls),
     path('accounts/', include('django.contrib.auth.urls')),
+    path('timing', timing_stats, name='timing'),
 ]
@@ -0,0 +1,19 @@
+from django.contrib import admin
+from django.utils import timezone
+
+from registration.models import OutboxMessage
+
+
+@admin.register(OutboxMessage)
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ('created', 'kind', 'recipient', 'status', 'attempts', 'next_attempt', 'last_error')
+    list_filter = ('status', 'kind')
+    search_fields = ('recipient', 'subject')
+    readonly_fields = ('registration', 'sent', 'claimed_by', 'claimed_until')
+    actions = ['retry']
+
+    def retry(self, request, queryset):
+        num = queryset.exclude(status=OutboxMessage.SENT).update(
+            status=OutboxMessage.PENDING, attempts=0, next_attempt=timezone.now(), last_error='')
+        self.message_user(request, '%i message(s) queued again' % num)
+    retry.short_description = 'Send the selected messages again'
@@ -0,0 +1,88 @@
+import random
+import time
+
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction, OperationalError
+from django.db.models import F
+from django.utils.translation import gettext_lazy as _, ngettext_lazy
+
+from registration.models import Subject, Event
+from registration.seating import allocate_seats, save_seats
+
+# number of attempts to book when the event is locked by concurrent bookings
+RETRIES = 5
+# base delay in seconds before retrying a booking, doubled on every attempt
+RETRY_DELAY = 0.05
+
+
+def lock_events(*pks):
+    """
+        Lock the rows of the given events until the end of the current transaction
+        :return: dict of the freshly read events by pk
+    """
+    pks = sorted(set(pks))
+    if connection.features.has_select_for_update:
+        return Event.objects.select_for_update().in_bulk(pks)
+    # sqlite has no row locks, but a write takes the database lock for the rest of the transaction
+    Event.objects.filter(pk__in=pks).update(seats_taken=F('seats_taken'))
+    return Event.objects.in_bulk(pks)
+
+
+def check_capacity(ev, num_seats, booked=0):
+    """
+        Raise a ValidationError if num_seats can't be booked for the event.
+        booked are the seats the subject already holds for this event.
+    """
+    taken = ev.seats_taken
+    # allow subject to decrease registration even if all seats are taken
+    if taken >= ev.num_total_seats:
+        if num_seats > booked:
+            raise ValidationError(_('no_seats_event'), code='invalid')
+    # if not all seats are taken, allow subject to fill up seats up to num_total_seats
+    elif taken-booked+num_seats > ev.num_total_seats:
+        raise ValidationError(ngettext_lazy(
+            'max_seats_exceeded_%(num_free)i',
+            'max_seats_exceeded_pl_%(num_free)i',
+            ev.num_total_seats-taken), code='invalid', params={'num_free': ev.num_total_seats-taken})
+
+
+def _book(form, check):
+    instance = form.instance
+    ev = lock_events(instance.event_id)[instance.event_id]
+
+    old = None
+    if instance.pk is not None:
+        old = Subject.objects.filter(pk=instance.pk).values('event_id', 'num_seats').first()
+        # the subject is moved to another event, also lock the one it leaves
+        if old and old['event_id'] != ev.pk:
+            lock_events(old['event_id'])
+            old = None
+    if check:
+        check_capacity(ev, instance.num_seats, old['num_seats'] if old else 0)
+    seats = allocate_seats(ev, instance, instance.num_seats)
+    subject = form.save()
+    save_seats(ev, subject, seats)
+    return subject
+
+
+def book(form, check=True):
+    """
+        Save the registration of a valid SubjectForm in one transaction with the event row locked,
+        so that the capacity check and the seat assignment can't interleave with other bookings.
+        :param check: verify that the event has enough free seats
+        :raises ValidationError: if the seats can't be booked
+    """
+    instance = form.instance
+    creating = instance._state.adding
+    for attempt in range(RETRIES):
+        if creating:
+            # a rolled back attempt leaves the pk of the row it inserted on the instance
+            instance.pk = None
+            instance._state.adding = True
+        try:
+            with transaction.atomic():
+                return _book(form, check)
+        except OperationalError:
+            if attempt == RETRIES-1:
+                raise
+            time.sleep(RETRY_DELAY * 2**attempt * random.uniform(.5, 1.5))
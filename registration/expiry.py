@@ -0,0 +1,37 @@
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from registration.mails import cancellation_message, outbox_message
+from registration.models import Subject, OutboxMessage, lock_rows, release_in_bulk
+
+from mysite import settings
+
+
+def expired(now):
+    # the reminder was sent, but the registration wasn't confirmed within hold_back_hours
+    return Q(confirmation_request_sent=True, status_confirmed=False, reminder_sent=True, cancel_due_at__lte=now)
+
+
+def expire_registrations(chunk_size=None):
+    """
+        Delete the registrations that weren't confirmed in time and queue their cancellation
+        mails, chunk_size registrations per transaction
+        :return: the number of deleted registrations
+    """
+    chunk_size = chunk_size or settings.EXPIRY_CHUNK_SIZE
+    query = expired(timezone.now())
+    pks = list(Subject.objects.filter(query).order_by('cancel_due_at').values_list('pk', flat=True))
+    num = 0
+    for i in range(0, len(pks), chunk_size):
+        with transaction.atomic(), release_in_bulk():
+            # skip registrations confirmed in the meantime
+            locked = list(lock_rows(Subject.objects.filter(query, pk__in=pks[i:i+chunk_size]), 'reminder_sent')
+                          .values_list('pk', flat=True))
+            subs = Subject.objects.filter(pk__in=locked).select_related('event')
+            OutboxMessage.objects.bulk_create([outbox_message('cancellation', sub, cancellation_message(sub))
+                                               for sub in subs])
+            # the seat assignments are deleted with them
+            subs.delete()
+        num += len(locked)
+    return num
@@ -0,0 +1,93 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.db.models import Count, Max
+from django.utils import timezone
+from django.utils.translation import get_language
+
+from registration import sub_table_html, sub_table_tex
+from registration.models import Subject, ExportJob
+from registration.seating import iterate_with_seats
+
+from mysite import settings
+
+_executor = ThreadPoolExecutor(max_workers=settings.EXPORT_WORKERS, thread_name_prefix='export')
+
+# PARTICIPANT_LIST_RENDERER: (function, file format)
+RENDERERS = {
+    'latex': (sub_table_tex.create_table, 'pdf'),
+    'html': (sub_table_html.create_table, 'html'),
+}
+
+
+def renderer():
+    return RENDERERS[settings.PARTICIPANT_LIST_RENDERER]
+
+
+def fingerprint(ev):
+    """
+        Identifies the content of the participant list of the event, changes with every
+        modification of a registration and of the event fields shown in the list
+    """
+    subs = Subject.objects.filter(event=ev).aggregate(count=Count('pk'), last=Max('reg_date'))
+    data = (ev.revision, subs['count'], subs['last'], ev.title, ev.date,
+            ev.assigned_seats, ev.num_max_per_subject, get_language(), settings.PARTICIPANT_LIST_RENDERER)
+    return hashlib.sha1(repr(data).encode()).hexdigest()
+
+
+def request_export(ev):
+    """
+        Get the export of the current participant list of the event, start it in the background if needed
+        :return: the ExportJob
+    """
+    job, created = ExportJob.objects.get_or_create(
+        event=ev, fingerprint=fingerprint(ev), defaults=dict(format=renderer()[1]))
+    lost = job.status in (ExportJob.PENDING, ExportJob.RUNNING) and \
+        job.created < timezone.now() - timedelta(seconds=settings.EXPORT_STALE_SECONDS)
+    missing = job.status == ExportJob.DONE and not os.path.exists(job.file_path)
+    if created or lost or missing or job.status == ExportJob.FAILED:
+        ExportJob.objects.filter(pk=job.pk).update(
+            status=ExportJob.PENDING, created=timezone.now(), finished=None, error='')
+        job.refresh_from_db()
+        transaction.on_commit(lambda: _executor.submit(_run_in_thread, job.pk))
+    return job
+
+
+def run(job_pk):
+    """
+        Build the participant list of an ExportJob
+    """
+    try:
+        job = ExportJob.objects.select_related('event').get(pk=job_pk)
+        job.status = ExportJob.RUNNING
+        job.save(update_fields=['status'])
+
+        ev = job.event
+        subs = Subject.objects.filter(event=ev).order_by('name', 'given_name', 'email')
+        os.makedirs(settings.EXPORT_ROOT, exist_ok=True)
+        create_table = renderer()[0]
+        create_table(ev, iterate_with_seats(subs), job.file_path)
+
+        job.status, job.finished = ExportJob.DONE, timezone.now()
+        job.save(update_fields=['status', 'finished'])
+
+        # finished results of older registrations are of no use anymore, newer jobs are still needed
+        for old in ExportJob.objects.filter(event=ev, status__in=(ExportJob.DONE, ExportJob.FAILED),
+                                            created__lt=job.created).exclude(pk=job.pk):
+            if os.path.exists(old.file_path):
+                os.remove(old.file_path)
+            old.delete()
+    except Exception as e:
+        ExportJob.objects.filter(pk=job_pk).update(
+            status=ExportJob.FAILED, finished=timezone.now(), error=str(e))
+
+
+def _run_in_thread(job_pk):
+    try:
+        run(job_pk)
+    finally:
+        # the thread is reused, don't keep its connection open
+        connection.close()
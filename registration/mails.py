@@ -0,0 +1,138 @@
+import os
+import re
+from functools import lru_cache
+
+from django.core.mail import EmailMultiAlternatives
+from django.utils import translation
+from django.utils.html import escape
+from django.utils.translation import gettext_lazy as _, ngettext
+
+from registration.models import Event, OutboxMessage
+
+from mysite import settings
+
+# mail type: (subject, body, fields of the event used in the body)
+MAILS = {
+    ## send when the subject registers for the event,
+    ## contains the link for the registration confirmation
+    'confirmation_request': (
+        _('Registration for %s'),
+        _('mail_body_%(name)s_%(event)s_%(hold_back_hours)i_%(confirm_url)s'),
+        lambda ev: dict(hold_back_hours=ev.hold_back_hours)),
+    ## send after some timeout to warn about registration deletion
+    'reminder': (
+        _('Reminder of registration for %s'),
+        _('reminder_body_%(name)s_%(event)s_%(cancel_hours)i_%(confirm_url)s_%(modify_url)s'),
+        lambda ev: dict(cancel_hours=ev.hold_back_hours - ev.reminder_hours)),
+    ## send when the subject clicked on the registration confirmation link
+    'confirmation': (
+        _('Confirmed registration for %s'),
+        _('confirmation_body_%(name)s_%(event)s_%(modify_url)s_%(seats)s'),
+        lambda ev: dict()),
+    'cancellation': (
+        _('Cancellation of registration for %s'),
+        _('cancellation_body_%(name)s_%(event)s'),
+        lambda ev: dict()),
+}
+
+FIELD = re.compile(r'%\((\w+)\)[si]')
+URL_FIELDS = ('confirm_url', 'modify_url')
+
+
+def _fill(template, fields):
+    # substitute the given fields, the others are kept for MessageTemplate.render()
+    return FIELD.sub(lambda m: str(fields[m.group(1)]).replace('%', '%%')
+                     if m.group(1) in fields else m.group(0), template)
+
+
+class MessageTemplate(object):
+    """
+        Subject and body of a mail type for one event in one language, with everything but the
+        fields of the registration filled in
+    """
+    def __init__(self, language, kind, ev):
+        self.language = language
+        self.kind = kind
+        self.assigned_seats = ev.assigned_seats
+        # the urls of the registration are appended to it
+        self.base_url = os.path.join(settings.BASE_URL, '')
+        subject, body, event_fields = MAILS[kind]
+        with translation.override(language):
+            self.subject = str(subject) % ev.title
+            self.body = _fill(str(body), dict(event=str(ev), **event_fields(ev)))
+        self.html = None
+        if settings.MAIL_HTML:
+            html = escape(self.body).replace('\n\n', '</p>\n<p>').replace('\n', '<br>\n')
+            for field in URL_FIELDS:
+                html = html.replace('%%(%s)s' % field, '<a href="%%(%s)s">%%(%s)s</a>' % (field, field))
+            self.html = '<!DOCTYPE html>\n<html>\n<body>\n<p>%s</p>\n</body>\n</html>\n' % html
+        self._seats = {}
+
+    def seats(self, sub):
+        if not self.assigned_seats:
+            return ''
+        if sub.num_seats not in self._seats:
+            with translation.override(self.language):
+                self._seats[sub.num_seats] = ngettext(
+                    'subject_seats_%(seat_nums)s', 'subject_seats_pl_%(seat_nums)s', sub.num_seats)
+        return self._seats[sub.num_seats] % dict(seat_nums=sub.seats) + \
+            '\n(Plan: %s/static/registration/GHS_physik.pdf)\n' % settings.BASE_URL
+
+    def render(self, sub):
+        fields = dict(
+            name=sub.given_name,
+            confirm_url=self.base_url + sub.token + '/confirm',
+            modify_url=self.base_url + sub.token + '/modify',
+        )
+        if self.kind == 'confirmation':
+            fields['seats'] = self.seats(sub)
+        message = EmailMultiAlternatives(
+            self.subject, self.body % fields, settings.DEFAULT_FROM_EMAIL, [sub.email])
+        if self.html is not None:
+            message.attach_alternative(self.html % {k: escape(v) for k, v in fields.items()}, 'text/html')
+        return message
+
+
+@lru_cache(maxsize=1024)
+def _template(language, html, kind, event_id, title, date, reminder_hours, hold_back_hours, assigned_seats):
+    ev = Event(pk=event_id, title=title, date=date, reminder_hours=reminder_hours,
+               hold_back_hours=hold_back_hours, assigned_seats=assigned_seats)
+    return MessageTemplate(language, kind, ev)
+
+
+def template(kind, ev):
+    """
+        The MessageTemplate of the mail type for the event in the current language, compiled
+        once and cached as long as the fields of the event used in the mails don't change
+    """
+    return _template(translation.get_language(), settings.MAIL_HTML, kind, ev.pk, ev.title, ev.date,
+                     ev.reminder_hours, ev.hold_back_hours, ev.assigned_seats)
+
+
+def confirmation_request_message(sub):
+    return template('confirmation_request', sub.event).render(sub)
+
+
+def remainder_message(sub):
+    return template('reminder', sub.event).render(sub)
+
+
+def confirmation_message(sub):
+    return template('confirmation', sub.event).render(sub)
+
+
+def cancellation_message(sub):
+    return template('cancellation', sub.event).render(sub)
+
+
+def outbox_message(kind, sub, message):
+    html = [content for content, mimetype in message.alternatives if mimetype == 'text/html']
+    return OutboxMessage(registration_id=sub.pk, kind=kind, recipient=message.to[0],
+                         subject=message.subject, body=message.body, html_body=html[0] if html else '')
+
+
+def outbox_email(msg):
+    message = EmailMultiAlternatives(msg.subject, msg.body, settings.DEFAULT_FROM_EMAIL, [msg.recipient])
+    if msg.html_body:
+        message.attach_alternative(msg.html_body, 'text/html')
+    return message
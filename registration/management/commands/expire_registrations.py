@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from registration.expiry import expire_registrations
+from registration.wakeup import notify
+
+
+class Command(BaseCommand):
+    help = 'Delete the registrations that were not confirmed in time and queue their cancellation mails'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, help='registrations deleted per transaction, default: EXPIRY_CHUNK_SIZE')
+
+    def handle(self, *args, **options):
+        num = expire_registrations(options['chunk_size'])
+        if num:
+            # the mailer sends the cancellations right away
+            notify()
+        self.stdout.write(self.style.SUCCESS('%i registration(s) expired' % num))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from registration.models import Event, recount_seats
+from registration.snapshot import invalidate
+
+
+class Command(BaseCommand):
+    help = 'Recompute the seat counters of the events from their registrations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('event', nargs='*', type=int, help='ids of the events to recount, default: all')
+
+    def handle(self, *args, **options):
+        events = Event.objects.all()
+        if options['event']:
+            events = events.filter(pk__in=options['event'])
+
+        drifted = recount_seats(events)
+        if drifted:
+            invalidate()
+        for ev, seats_taken, confirmed_seats in drifted:
+            self.stdout.write('%s: seats_taken %i -> %i, confirmed_seats %i -> %i' % (
+                ev, seats_taken, ev.seats_taken, confirmed_seats, ev.confirmed_seats))
+        self.stdout.write(self.style.SUCCESS('%i event(s) corrected' % len(drifted)))
@@ -0,0 +1,66 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:03
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import registration.models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Event',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(help_text='name of the event', max_length=1024)),
+                ('date', models.DateTimeField(default=django.utils.timezone.now, help_text='date and time of the event')),
+                ('is_active', models.BooleanField(default=True)),
+                ('num_total_seats', models.IntegerField(help_text='total number of seats available')),
+                ('num_max_per_subject', models.IntegerField(default=5, help_text='maximum number of seats that can be booked by one person')),
+                ('enable_on', models.DateTimeField(default=django.utils.timezone.now, verbose_name='enable_on')),
+                ('disable_on', models.DateTimeField(default=django.utils.timezone.now, verbose_name='disable_on')),
+                ('assigned_seats', models.BooleanField(default=False, help_text='each entry has an assigned seat number')),
+                ('reminder_hours', models.IntegerField(default=12, help_text='hours to wait after registration before sending the reminder for the registration confirmation')),
+                ('hold_back_hours', models.IntegerField(default=24, help_text='hours to wait after registration before cancelling a registration that was not confirmed')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SubjectBase',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200, verbose_name='name')),
+                ('given_name', models.CharField(max_length=200, verbose_name='given_name')),
+                ('email', models.EmailField(max_length=200, verbose_name='email')),
+                ('reg_date', models.DateTimeField(default=django.utils.timezone.now, verbose_name='reg_date')),
+                ('num_seats', models.IntegerField(default=1, validators=[django.core.validators.MinValueValidator(1)], verbose_name='num_seats')),
+                ('seats', models.CharField(default='', max_length=1024, validators=[django.core.validators.int_list_validator], verbose_name='seats')),
+                ('status_confirmed', models.BooleanField(default=False, verbose_name='status_confirmed')),
+                ('confirmation_request_sent', models.BooleanField(default=False, verbose_name='confirmation_request_sent')),
+                ('confirmation_sent', models.BooleanField(default=False, verbose_name='confirmation_sent')),
+                ('reminder_sent', models.BooleanField(default=False, verbose_name='reminder_sent')),
+                ('token', models.CharField(default=registration.models.token, max_length=255)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='registration.Event', verbose_name='event')),
+            ],
+            options={
+                'unique_together': {('event', 'email')},
+            },
+        ),
+        migrations.CreateModel(
+            name='SubjectExtended',
+            fields=[
+                ('subjectbase_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='registration.SubjectBase')),
+                ('address', models.CharField(max_length=50, verbose_name='address')),
+                ('city', models.CharField(max_length=60, verbose_name='city')),
+                ('post_code', models.IntegerField(verbose_name='post_code')),
+                ('phone', models.CharField(max_length=50, verbose_name='phone')),
+            ],
+            bases=('registration.subjectbase',),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:04
+
+from django.db import migrations, models
+
+
+def count_seats(apps, schema_editor):
+    Event = apps.get_model('registration', 'Event')
+    SubjectBase = apps.get_model('registration', 'SubjectBase')
+    for ev in Event.objects.all():
+        subs = SubjectBase.objects.filter(event=ev)
+        ev.seats_taken = sum(s.num_seats for s in subs)
+        ev.confirmed_seats = sum(s.num_seats for s in subs if s.status_confirmed)
+        ev.save(update_fields=['seats_taken', 'confirmed_seats'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='confirmed_seats',
+            field=models.IntegerField(default=0, editable=False, help_text='number of seats of confirmed registrations'),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='seats_taken',
+            field=models.IntegerField(default=0, editable=False, help_text='number of seats booked'),
+        ),
+        migrations.RunPython(count_seats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:09
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def seats_to_assignments(apps, schema_editor):
+    SubjectBase = apps.get_model('registration', 'SubjectBase')
+    SeatAssignment = apps.get_model('registration', 'SeatAssignment')
+    taken, assignments = set(), []
+    for sub in SubjectBase.objects.exclude(seats='').order_by('reg_date', 'pk'):
+        for seat in sub.seats.split(','):
+            # seats handed out twice by concurrent bookings stay with the earlier registration
+            if (sub.event_id, int(seat)) in taken:
+                continue
+            taken.add((sub.event_id, int(seat)))
+            assignments.append(SeatAssignment(event_id=sub.event_id, subject_id=sub.pk, seat_number=int(seat)))
+    SeatAssignment.objects.bulk_create(assignments, batch_size=1000)
+
+
+def assignments_to_seats(apps, schema_editor):
+    SubjectBase = apps.get_model('registration', 'SubjectBase')
+    SeatAssignment = apps.get_model('registration', 'SeatAssignment')
+    seats = {}
+    for subject_id, seat in SeatAssignment.objects.order_by('seat_number').values_list('subject_id', 'seat_number'):
+        seats.setdefault(subject_id, []).append(str(seat))
+    for sub in SubjectBase.objects.filter(pk__in=seats.keys()):
+        sub.seats = ','.join(seats[sub.pk])
+        sub.save(update_fields=['seats'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0002_seat_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SeatAssignment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seat_number', models.IntegerField(validators=[django.core.validators.MinValueValidator(1)], verbose_name='seat_number')),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='registration.Event', verbose_name='event')),
+                ('subject', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='seat_assignments', to='registration.SubjectBase')),
+            ],
+            options={
+                'unique_together': {('event', 'seat_number')},
+            },
+        ),
+        migrations.RunPython(seats_to_assignments, assignments_to_seats),
+        migrations.RemoveField(
+            model_name='subjectbase',
+            name='seats',
+        ),
+    ]
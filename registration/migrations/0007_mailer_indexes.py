@@ -0,0 +1,25 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0006_mail_relay_bucket'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='subjectbase',
+            index=models.Index(fields=['confirmation_request_sent', 'reg_date'], name='subject_request_sent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subjectbase',
+            index=models.Index(fields=['status_confirmed', 'confirmation_sent', 'reg_date'], name='subject_confirmed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subjectbase',
+            index=models.Index(fields=['status_confirmed', 'reminder_sent', 'reg_date'], name='subject_reminder_sent_idx'),
+        ),
+    ]
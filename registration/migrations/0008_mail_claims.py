@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0007_mailer_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subjectbase',
+            name='mail_claimed_by',
+            field=models.CharField(blank=True, default='', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='subjectbase',
+            name='mail_claimed_until',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
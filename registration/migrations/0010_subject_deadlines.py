@@ -0,0 +1,48 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:25
+
+from datetime import timedelta
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def compute_deadlines(apps, schema_editor):
+    Event = apps.get_model('registration', 'Event')
+    SubjectBase = apps.get_model('registration', 'SubjectBase')
+    for ev in Event.objects.all():
+        SubjectBase.objects.filter(event=ev).update(
+            reminder_due_at=F('reg_date') + timedelta(hours=ev.reminder_hours),
+            cancel_due_at=F('reg_date') + timedelta(hours=ev.hold_back_hours))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0009_outbox_message'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='subjectbase',
+            name='subject_reminder_sent_idx',
+        ),
+        migrations.AddField(
+            model_name='subjectbase',
+            name='cancel_due_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='subjectbase',
+            name='reminder_due_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(compute_deadlines, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='subjectbase',
+            index=models.Index(fields=['status_confirmed', 'reminder_sent', 'reminder_due_at'], name='subject_reminder_due_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subjectbase',
+            index=models.Index(fields=['status_confirmed', 'reminder_sent', 'cancel_due_at'], name='subject_cancel_due_idx'),
+        ),
+    ]
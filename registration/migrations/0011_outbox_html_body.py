@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0010_subject_deadlines'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='html_body',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0011_outbox_html_body'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='subjectbase',
+            index=models.Index(fields=['reg_date', 'id'], name='subject_reg_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subjectbase',
+            index=models.Index(fields=['name', 'id'], name='subject_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subjectbase',
+            index=models.Index(fields=['event', 'reg_date', 'id'], name='subject_event_reg_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subjectbase',
+            index=models.Index(fields=['event', 'name', 'id'], name='subject_event_name_idx'),
+        ),
+    ]
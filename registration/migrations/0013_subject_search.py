@@ -0,0 +1,79 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:35
+
+from django.db import migrations, models
+import registration.models
+
+SEARCH_COLUMNS = ('search_name', 'search_given_name', 'search_email')
+
+
+def fill_search_columns(apps, schema_editor):
+    SubjectBase = apps.get_model('registration', 'SubjectBase')
+    subs = []
+    for sub in SubjectBase.objects.only('name', 'given_name', 'email').iterator():
+        sub.search_name, sub.search_given_name, sub.search_email = \
+            sub.name.casefold(), sub.given_name.casefold(), sub.email.casefold()
+        subs.append(sub)
+    SubjectBase.objects.bulk_update(subs, SEARCH_COLUMNS, batch_size=500)
+
+
+def create_trigram_indexes(apps, schema_editor):
+    # substring search on PostgreSQL, the other databases use the prefix indexes of the model
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    table = schema_editor.quote_name(apps.get_model('registration', 'SubjectBase')._meta.db_table)
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for column in ('name', 'given_name', 'email'):
+        # the expression of the icontains lookup
+        schema_editor.execute('CREATE INDEX subject_%s_trgm_idx ON %s USING gin (UPPER(%s::text) gin_trgm_ops)'
+                              % (column, table, schema_editor.quote_name(column)))
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for column in ('name', 'given_name', 'email'):
+        schema_editor.execute('DROP INDEX IF EXISTS subject_%s_trgm_idx' % column)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0012_subject_list_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subjectbase',
+            name='search_email',
+            field=models.CharField(blank=True, default='', editable=False, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='subjectbase',
+            name='search_given_name',
+            field=models.CharField(blank=True, default='', editable=False, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='subjectbase',
+            name='search_name',
+            field=models.CharField(blank=True, default='', editable=False, max_length=200),
+        ),
+        migrations.AlterField(
+            model_name='subjectbase',
+            name='token',
+            field=models.CharField(db_index=True, default=registration.models.token, max_length=255),
+        ),
+        migrations.RunPython(fill_search_columns, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='subjectbase',
+            index=models.Index(fields=['search_name'], name='subject_search_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subjectbase',
+            index=models.Index(fields=['search_given_name'], name='subject_search_given_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subjectbase',
+            index=models.Index(fields=['search_email'], name='subject_search_email_idx'),
+        ),
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
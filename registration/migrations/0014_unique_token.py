@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:37
+
+from django.db import migrations, models
+import registration.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0013_subject_search'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='subjectbase',
+            name='token',
+            field=models.CharField(default=registration.models.token, max_length=255, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='subjectbase',
+            index=models.Index(fields=['event', 'status_confirmed'], name='subject_event_confirmed_idx'),
+        ),
+    ]
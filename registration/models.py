@@ -1,11 +1,19 @@
+import os
 import secrets
+import threading
+
+from contextlib import contextmanager
+from datetime import timedelta
 
 from django.core.validators import MinValueValidator
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 from django.urls import reverse
 from django.utils.translation import ugettext_lazy as _
-from django.core.validators import int_list_validator
 
 from mysite import settings
 
@@ -22,9 +30,35 @@ class Event(models.Model):
     reminder_hours = models.IntegerField(default=12, help_text="hours to wait after registration before sending the reminder for the registration confirmation")
     hold_back_hours = models.IntegerField(default=24, help_text="hours to wait after registration before cancelling a registration that was not confirmed")
 
-    @property
-    def seats_taken(self):
-        return sum(map(lambda x: x.num_seats, Subject.objects.filter(event=self)))
+    # denormalized seat counters, maintained by SubjectBase.save() and the post_delete handler below
+    seats_taken = models.IntegerField(default=0, editable=False, help_text="number of seats booked")
+    confirmed_seats = models.IntegerField(default=0, editable=False, help_text="number of seats of confirmed registrations")
+    # incremented on every change of a registration of the event
+    revision = models.IntegerField(default=0, editable=False)
+
+    COUNTER_FIELDS = ('seats_taken', 'confirmed_seats', 'revision')
+
+    def save(self, *args, **kwargs):
+        # never write back the counters of an already existing event, they might be stale
+        if self.pk is not None and not self._state.adding and 'update_fields' not in kwargs \
+                and not kwargs.get('force_insert', False):
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields
+                                       if not f.primary_key and f.name not in self.COUNTER_FIELDS]
+        old = None
+        if self.pk is not None and not self._state.adding:
+            old = Event.objects.filter(pk=self.pk).values('reminder_hours', 'hold_back_hours').first()
+        super(Event, self).save(*args, **kwargs)
+        if old is not None and (old['reminder_hours'], old['hold_back_hours']) != (self.reminder_hours, self.hold_back_hours):
+            SubjectBase.objects.filter(event=self).update(
+                reminder_due_at=F('reg_date') + timedelta(hours=self.reminder_hours),
+                cancel_due_at=F('reg_date') + timedelta(hours=self.hold_back_hours))
+
+    @staticmethod
+    def registrations_changed(event_id, seats=0, confirmed=0):
+        Event.objects.filter(pk=event_id).update(
+            seats_taken=F('seats_taken') + seats,
+            confirmed_seats=F('confirmed_seats') + confirmed,
+            revision=F('revision') + 1)
 
     def get_absolute_url(self):
         return reverse('event-detail', args=[self.id])
@@ -37,6 +71,25 @@ def token():
     return secrets.token_urlsafe(32)
 
 
+def search_key(value):
+    # normalized form of the search columns, see registration.search
+    return value.casefold()
+
+
+def lock_rows(queryset, field):
+    """
+        Lock the rows of the queryset until the end of the current transaction
+        :param field: a column of the rows, sqlite has no row locks and takes the database lock
+            with a no-op update of it instead. A read before the first write of a transaction
+            fails there instead of waiting if another transaction is writing.
+        :return: the queryset to read the locked rows
+    """
+    if connection.features.has_select_for_update:
+        return queryset.select_for_update()
+    queryset.update(**{field: F(field)})
+    return queryset
+
+
 class SubjectBase(models.Model):
     name = models.CharField(_('name'), max_length=200)
     given_name = models.CharField(_('given_name'), max_length=200)
@@ -45,16 +98,90 @@ class SubjectBase(models.Model):
     event = models.ForeignKey(Event, verbose_name=_('event'), on_delete=models.CASCADE)
     reg_date = models.DateTimeField(_('reg_date'), default=timezone.now)
     num_seats = models.IntegerField(_('num_seats'), default=1, validators=[MinValueValidator(1)])
-    seats = models.CharField(_('seats'), max_length=1024, default='', validators=[int_list_validator])
 
     status_confirmed = models.BooleanField(_('status_confirmed'), default=False)
     confirmation_request_sent = models.BooleanField(_('confirmation_request_sent'), default=False)
     confirmation_sent = models.BooleanField(_('confirmation_sent'), default=False)
     reminder_sent = models.BooleanField(_('reminder_sent'), default=False)
-    token = models.CharField(max_length=255, default=token)
+    # identifies the registration in the links of the mails
+    token = models.CharField(max_length=255, default=token, unique=True)
+
+    # lowercase copies of the searched columns, indexed for prefix searches, see registration.search
+    search_name = models.CharField(max_length=200, blank=True, default='', editable=False)
+    search_given_name = models.CharField(max_length=200, blank=True, default='', editable=False)
+    search_email = models.CharField(max_length=200, blank=True, default='', editable=False)
+
+    # deadlines of the reminder and the cancellation, from reg_date and the hours of the event
+    reminder_due_at = models.DateTimeField(null=True, blank=True, editable=False)
+    cancel_due_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    # claim of a mailer worker, see mailing.claim(); maintained with queryset updates only
+    mail_claimed_by = models.CharField(max_length=255, blank=True, default='', editable=False)
+    mail_claimed_until = models.DateTimeField(null=True, blank=True, editable=False)
+
+    CLAIM_FIELDS = ('mail_claimed_by', 'mail_claimed_until')
 
     class Meta:
         unique_together = ('event', 'email')
+        # queries of the mailer
+        indexes = [
+            models.Index(fields=['confirmation_request_sent', 'reg_date'], name='subject_request_sent_idx'),
+            models.Index(fields=['status_confirmed', 'confirmation_sent', 'reg_date'], name='subject_confirmed_idx'),
+            models.Index(fields=['status_confirmed', 'reminder_sent', 'reminder_due_at'], name='subject_reminder_due_idx'),
+            models.Index(fields=['status_confirmed', 'reminder_sent', 'cancel_due_at'], name='subject_cancel_due_idx'),
+            # keyset pagination of the subject list, see registration.paging
+            models.Index(fields=['reg_date', 'id'], name='subject_reg_date_idx'),
+            models.Index(fields=['name', 'id'], name='subject_name_idx'),
+            models.Index(fields=['event', 'reg_date', 'id'], name='subject_event_reg_date_idx'),
+            models.Index(fields=['event', 'name', 'id'], name='subject_event_name_idx'),
+            # seat counters of an event, see recount_seats()
+            models.Index(fields=['event', 'status_confirmed'], name='subject_event_confirmed_idx'),
+            # prefix search, see registration.search
+            models.Index(fields=['search_name'], name='subject_search_name_idx'),
+            models.Index(fields=['search_given_name'], name='subject_search_given_name_idx'),
+            models.Index(fields=['search_email'], name='subject_search_email_idx'),
+        ]
+
+    @property
+    def confirmed_seats(self):
+        return self.num_seats if self.status_confirmed else 0
+
+    @property
+    def seat_numbers(self):
+        # uses the cache of prefetch_related('seat_assignments') if available
+        return sorted(a.seat_number for a in self.seat_assignments.all())
+
+    @property
+    def seats(self):
+        return ','.join(map(str, self.seat_numbers))
+
+    def save(self, *args, **kwargs):
+        # never write back the claim of a mailer worker, it might be stale
+        if self.pk is not None and not self._state.adding and 'update_fields' not in kwargs \
+                and not kwargs.get('force_insert', False):
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields
+                                       if not f.primary_key and f.name not in self.CLAIM_FIELDS]
+        self.reminder_due_at = self.reg_date + timedelta(hours=self.event.reminder_hours)
+        self.cancel_due_at = self.reg_date + timedelta(hours=self.event.hold_back_hours)
+        self.search_name = search_key(self.name)
+        self.search_given_name = search_key(self.given_name)
+        self.search_email = search_key(self.email)
+        with transaction.atomic():
+            old = None
+            if self.pk is not None and not self._state.adding:
+                old = lock_rows(SubjectBase.objects.filter(pk=self.pk), 'num_seats') \
+                    .values('event_id', 'num_seats', 'status_confirmed').first()
+            super(SubjectBase, self).save(*args, **kwargs)
+
+            if old is not None and old['event_id'] != self.event_id:
+                Event.registrations_changed(old['event_id'], -old['num_seats'],
+                                   -old['num_seats'] if old['status_confirmed'] else 0)
+                old = None
+            seats, confirmed = self.num_seats, self.confirmed_seats
+            if old is not None:
+                seats -= old['num_seats']
+                confirmed -= old['num_seats'] if old['status_confirmed'] else 0
+            Event.registrations_changed(self.event_id, seats, confirmed)
 
     def get_absolute_url(self):
         return reverse('subject-modify', args=[self.token])
@@ -70,4 +197,153 @@ class SubjectExtended(SubjectBase):
     phone = models.CharField(_('phone'), max_length=50)
 
 
+class SeatAssignment(models.Model):
+    event = models.ForeignKey(Event, verbose_name=_('event'), on_delete=models.CASCADE)
+    seat_number = models.IntegerField(_('seat_number'), validators=[MinValueValidator(1)])
+    subject = models.ForeignKey(SubjectBase, related_name='seat_assignments', on_delete=models.CASCADE)
+
+    class Meta:
+        unique_together = ('event', 'seat_number')
+
+    def __str__(self):
+        return "%s: %i"%(self.event, self.seat_number)
+
+
+class ExportJob(models.Model):
+    """
+        Background build of the participant list of an event. The result is cached in
+        EXPORT_ROOT and reused as long as the fingerprint of the registrations doesn't change.
+    """
+    PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+    STATUS_CHOICES = [(s, s) for s in (PENDING, RUNNING, DONE, FAILED)]
+
+    event = models.ForeignKey(Event, on_delete=models.CASCADE)
+    fingerprint = models.CharField(max_length=64)
+    # file extension of the result, depends on the PARTICIPANT_LIST_RENDERER
+    format = models.CharField(max_length=10, default='pdf')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    created = models.DateTimeField(default=timezone.now)
+    finished = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True, default='')
+
+    class Meta:
+        unique_together = ('event', 'fingerprint')
+
+    @property
+    def file_path(self):
+        return os.path.join(settings.EXPORT_ROOT, '%i-%s.%s' % (self.event_id, self.fingerprint, self.format))
+
+    def get_absolute_url(self):
+        return reverse('events-participants-job', args=[self.event_id, self.pk])
+
+
+class MailRelayBucket(models.Model):
+    """
+        Persisted state of the token bucket limiting the mails sent over a relay, see registration.ratelimit
+    """
+    name = models.CharField(max_length=100, unique=True)
+    tokens = models.FloatField()
+    # unix time of the last update of tokens
+    updated = models.FloatField()
+
+    def __str__(self):
+        return self.name
+
+
+class OutboxMessage(models.Model):
+    """
+        A rendered mail waiting to be sent by the mailer. Failed mails are retried with
+        exponential backoff, after MAIL_MAX_ATTEMPTS they are dead and need to be retried by hand.
+    """
+    PENDING, SENT, DEAD = 'pending', 'sent', 'dead'
+    STATUS_CHOICES = [(s, s) for s in (PENDING, SENT, DEAD)]
+
+    # the registration the mail is about, kept after the registration is deleted (cancellations)
+    registration = models.ForeignKey(SubjectBase, null=True, blank=True, on_delete=models.SET_NULL)
+    kind = models.CharField(max_length=30)
+    recipient = models.EmailField(max_length=200)
+    subject = models.CharField(max_length=1024)
+    body = models.TextField()
+    # optional html alternative of the body, see MAIL_HTML
+    html_body = models.TextField(blank=True, default='')
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+    created = models.DateTimeField(default=timezone.now)
+    sent = models.DateTimeField(null=True, blank=True)
+
+    # claim of a mailer worker, see mailing.claim()
+    claimed_by = models.CharField(max_length=255, blank=True, default='', editable=False)
+    claimed_until = models.DateTimeField(null=True, blank=True, editable=False)
+
+    CLAIM_FIELDS = ('claimed_by', 'claimed_until')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt'], name='outbox_status_idx'),
+        ]
+
+    def __str__(self):
+        return '%s: %s' % (self.recipient, self.subject)
+
+
+# seats of deleted subjects by event, collected inside of release_in_bulk()
+_released = threading.local()
+
+
+@contextmanager
+def release_in_bulk():
+    """
+        Update the seat counters of every event only once for all subjects deleted in the block,
+        has to be used inside of a transaction
+    """
+    _released.seats = {}
+    try:
+        yield
+        for event_id, (seats, confirmed) in _released.seats.items():
+            Event.registrations_changed(event_id, -seats, -confirmed)
+    finally:
+        del _released.seats
+
+
+# also fired for queryset deletes and cascades; deleting a SubjectExtended sends it for its SubjectBase part
+@receiver(post_delete, sender=SubjectBase)
+def release_seats(sender, instance, **kwargs):
+    released = getattr(_released, 'seats', None)
+    if released is None:
+        Event.registrations_changed(instance.event_id, -instance.num_seats, -instance.confirmed_seats)
+        return
+    seats, confirmed = released.get(instance.event_id, (0, 0))
+    released[instance.event_id] = (seats + instance.num_seats, confirmed + instance.confirmed_seats)
+
+
+def recount_seats(events=None):
+    """
+        Recompute the seat counters of the given events (all if None) from their registrations
+        :return: list of (event, seats_taken, confirmed_seats) tuples with the counters before
+            the recount for every event whose counters had drifted
+    """
+    if events is None:
+        events = Event.objects.all()
+    subjects = SubjectBase.objects.filter(event=OuterRef('pk')).order_by().values('event')
+    total = Subquery(subjects.annotate(s=Sum('num_seats')).values('s'),
+                     output_field=models.IntegerField())
+    confirmed = Subquery(subjects.filter(status_confirmed=True).annotate(s=Sum('num_seats')).values('s'),
+                         output_field=models.IntegerField())
+
+    drifted = []
+    with transaction.atomic():
+        for ev in events.select_for_update().annotate(
+                actual_seats=Coalesce(total, 0), actual_confirmed=Coalesce(confirmed, 0)):
+            if (ev.seats_taken, ev.confirmed_seats) == (ev.actual_seats, ev.actual_confirmed):
+                continue
+            drifted.append((ev, ev.seats_taken, ev.confirmed_seats))
+            Event.objects.filter(pk=ev.pk).update(
+                seats_taken=ev.actual_seats, confirmed_seats=ev.actual_confirmed)
+            ev.seats_taken, ev.confirmed_seats = ev.actual_seats, ev.actual_confirmed
+    return drifted
+
+
 Subject = eval(settings.SUBJECT_CLASS)
@@ -0,0 +1,78 @@
+from django.core import signing
+from django.db import connection
+from django.db.models import Q
+
+SALT = 'registration.paging'
+
+
+class KeysetPage(object):
+    """
+        A page of a queryset ordered by one column and the primary key. Instead of an offset,
+        the page starts after (or ends before) the row of a cursor, so every page costs the
+        same index range scan, however far it is from the first one.
+    """
+    def __init__(self, queryset, ordering, per_page, after=None, before=None):
+        self.ordering = ordering
+        self.column = ordering.lstrip('-')
+        self.field = queryset.model._meta.get_field(self.column)
+        descending = ordering.startswith('-')
+
+        cursor = self._load(before)
+        backwards = cursor is not None
+        if not backwards:
+            cursor = self._load(after)
+        # scanning backwards from a cursor flips the order, the rows are reversed afterwards
+        if descending != backwards:
+            order, lt, lte = ('-%s' % self.column, '-pk'), 'lt', 'lte'
+        else:
+            order, lt, lte = (self.column, 'pk'), 'gt', 'gte'
+        if cursor is not None:
+            value, pk = cursor
+            # the redundant range condition lets the database use the index on the column
+            queryset = queryset.filter(**{'%s__%s' % (self.column, lte): value}).filter(
+                Q(**{'%s__%s' % (self.column, lt): value}) | Q(**{self.column: value, 'pk__%s' % lt: pk}))
+        rows = list(queryset.order_by(*order)[:per_page + 1])
+        more = len(rows) > per_page
+        self.object_list = rows[:per_page]
+
+        if backwards:
+            self.object_list.reverse()
+            self.has_previous, self.has_next = more, True
+        else:
+            self.has_previous, self.has_next = cursor is not None, more
+        self.previous_cursor = self._dump(self.object_list[0]) \
+            if self.has_previous and self.object_list else None
+        self.next_cursor = self._dump(self.object_list[-1]) \
+            if self.has_next and self.object_list else None
+
+    def _dump(self, obj):
+        return signing.dumps([self.ordering, self.field.value_to_string(obj), obj.pk], salt=SALT)
+
+    def _load(self, cursor):
+        # cursors of another ordering or tampered with start from the first page
+        if not cursor:
+            return None
+        try:
+            ordering, value, pk = signing.loads(cursor, salt=SALT)
+        except (signing.BadSignature, ValueError, TypeError):
+            return None
+        if ordering != self.ordering:
+            return None
+        return self.field.to_python(value), pk
+
+
+def count_rows(queryset):
+    """
+        The number of rows of the queryset, estimated from the statistics of the planner on
+        PostgreSQL if the queryset is not filtered
+        :return: (count, True if estimated)
+    """
+    if connection.vendor == 'postgresql' and not queryset.query.where:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+                           [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+        # -1 if the table was never analyzed
+        if row is not None and row[0] >= 0:
+            return int(row[0]), True
+    return queryset.count(), False
@@ -0,0 +1,92 @@
+import time
+
+from django.db import transaction
+from django.db.models import F
+
+from registration.models import MailRelayBucket, lock_rows
+
+
+class TokenBucket(object):
+    """
+        Allows rate mails per interval seconds and bursts of up to burst mails. The state is
+        stored in the db, it survives restarts and is shared by all mailer processes.
+    """
+    def __init__(self, name, rate, interval, burst, clock=time.time):
+        self.name = name
+        self.rate = rate
+        self.interval = interval
+        self.burst = burst
+        self.clock = clock
+
+    def take(self):
+        """
+            Take a token if there is one
+            :return: 0 if a token was taken, otherwise the seconds until the next one is available
+        """
+        now = self.clock()
+        with transaction.atomic():
+            buckets = lock_rows(MailRelayBucket.objects.filter(name=self.name), 'tokens')
+            bucket, created = buckets.get_or_create(name=self.name, defaults=dict(tokens=self.burst, updated=now))
+            tokens = min(self.burst, bucket.tokens + max(0, now - bucket.updated) * self.rate / self.interval)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) * self.interval / self.rate
+            bucket.tokens, bucket.updated = tokens, now
+            bucket.save(update_fields=['tokens', 'updated'])
+        return wait
+
+    def give_back(self):
+        """
+            Return a taken token that wasn't used, ie the relay was not reachable. take() caps
+            the tokens at burst.
+        """
+        MailRelayBucket.objects.filter(name=self.name).update(tokens=F('tokens') + 1)
+
+
+class Relay(object):
+    def __init__(self, name, rate, interval, burst, clock=time.time, **options):
+        self.name = name
+        self.bucket = TokenBucket(name, rate, interval, burst, clock)
+        # arguments of get_connection(), ie host, port, username, password, use_tls
+        self.options = options
+
+    def __str__(self):
+        return self.name
+
+
+class RelayPool(object):
+    """
+        The relays of MAIL_RELAYS, used in round-robin as long as their rate limit allows it
+    """
+    def __init__(self, relays, clock=time.time, sleep=time.sleep):
+        self.relays = [Relay(clock=clock, **relay) for relay in relays]
+        self.sleep = sleep
+        self._next = 0
+
+    def try_acquire(self):
+        """
+            Take a token of the next relay that has one
+            :return: (relay, 0) or (None, seconds until the next token is available)
+        """
+        waits = []
+        for i in range(len(self.relays)):
+            idx = (self._next + i) % len(self.relays)
+            wait = self.relays[idx].bucket.take()
+            if wait == 0:
+                self._next = idx + 1
+                return self.relays[idx], 0
+            waits.append(wait)
+        return None, min(waits)
+
+    def acquire(self):
+        """
+            Wait for the next relay allowed to send a mail
+            :return: the Relay
+        """
+        while True:
+            relay, wait = self.try_acquire()
+            if relay is not None:
+                return relay
+            self.sleep(wait)
@@ -0,0 +1,45 @@
+from functools import reduce
+from operator import and_
+
+from django.db import connection
+from django.db.models import Q
+
+from registration.models import search_key
+
+# the longest codepoint, the upper end of a prefix range
+MAX_CHAR = chr(0x10ffff)
+# the surrogates can't be encoded, the range skips them
+SURROGATES = range(0xd800, 0xe000)
+
+
+def _next_char(char):
+    code = ord(char) + 1
+    return chr(SURROGATES.stop if code in SURROGATES else code)
+
+
+def _prefix(column, prefix):
+    # a range instead of LIKE, a plain index on the column is used for it on every database
+    last = prefix[-1]
+    upper = prefix[:-1] + _next_char(last) if last != MAX_CHAR else prefix + MAX_CHAR
+    return Q(**{'%s__gte' % column: prefix, '%s__lt' % column: upper})
+
+
+def _word(word):
+    if connection.vendor == 'postgresql':
+        # icontains is backed by the trigram indexes of migration 0013
+        return Q(name__icontains=word) | Q(given_name__icontains=word) | Q(email__icontains=word) | \
+            Q(token__startswith=word)
+    key = search_key(word)
+    return _prefix('search_name', key) | _prefix('search_given_name', key) | _prefix('search_email', key) | \
+        _prefix('token', word)
+
+
+def search(queryset, query):
+    """
+        Subjects matching every word of the query in their name, given name or email, or whose
+        token starts with it. The words match anywhere on PostgreSQL, at the start elsewhere.
+    """
+    words = query.split()
+    if not words:
+        return queryset
+    return queryset.filter(reduce(and_, [_word(word) for word in words]))
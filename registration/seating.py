@@ -0,0 +1,114 @@
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.db.models import prefetch_related_objects
+
+from registration.models import SeatAssignment
+
+
+class SeatMap:
+    """
+        Occupancy of the seats of an event with one byte per seat, seat numbers start at 1.
+        Rebuilding it for a booking takes one indexed query, allocating uses bytearray.find()
+        instead of scanning the taken seats in python.
+    """
+    FREE, TAKEN = 0, 1
+
+    def __init__(self, num_seats, taken=()):
+        self.occupied = bytearray(num_seats)
+        self.take(taken)
+
+    @classmethod
+    def for_event(cls, ev, exclude=None):
+        """
+            :param exclude: subject whose seats are left free, ie because they are reassigned
+        """
+        taken = SeatAssignment.objects.filter(event=ev)
+        if exclude is not None and exclude.pk is not None:
+            taken = taken.exclude(subject_id=exclude.pk)
+        return cls(ev.num_total_seats, taken.values_list('seat_number', flat=True))
+
+    @property
+    def num_free(self):
+        return self.occupied.count(self.FREE)
+
+    def _set(self, seats, value):
+        occupied, size = self.occupied, len(self.occupied)
+        for s in seats:
+            # seats beyond the size of the hall (ie after it was reduced) are simply ignored
+            if 0 < s <= size:
+                occupied[s-1] = value
+
+    def take(self, seats):
+        self._set(seats, self.TAKEN)
+
+    def release(self, seats):
+        self._set(seats, self.FREE)
+
+    def allocate(self, num_seats, current=()):
+        """
+            Take num_seats seats, preferably next to each other.
+            :param current: seats the subject holds already, they are kept as far as possible
+            :return: the sorted list of allocated seat numbers
+            :raises ValidationError: if there are not enough free seats
+        """
+        current = sorted(current)
+        if num_seats <= len(current):
+            self.release(current[num_seats:])
+            return current[:num_seats]
+
+        self.release(current)
+        # first fit of a contiguous block, so that groups sit together
+        idx = self.occupied.find(bytes(num_seats))
+        if idx >= 0:
+            seats = list(range(idx+1, idx+num_seats+1))
+        else:
+            # no block big enough, fill up the gaps starting with the lowest seat numbers
+            seats, idx = [], self.occupied.find(self.FREE)
+            while idx >= 0 and len(seats) < num_seats:
+                seats.append(idx+1)
+                idx = self.occupied.find(self.FREE, idx+1)
+
+        if len(seats) != num_seats:
+            self.take(current)
+            raise ValidationError("Unable to assign seats", code='invalid')
+        self.take(seats)
+        return seats
+
+
+def allocate_seats(ev, subject, num_seats):
+    """
+        Find the seats for a booking, the subject keeps the seats it holds for the event as far as possible
+        :return: the seat numbers, empty if the event has no assigned seats
+    """
+    if not ev.assigned_seats:
+        return []
+    current = []
+    if subject.pk is not None:
+        current = SeatAssignment.objects.filter(event=ev, subject_id=subject.pk) \
+            .values_list('seat_number', flat=True)
+    return SeatMap.for_event(ev, exclude=subject).allocate(num_seats, current)
+
+
+def save_seats(ev, subject, seats):
+    """
+        Replace the seat assignments of the saved subject with the given seats of the event
+    """
+    SeatAssignment.objects.filter(subject_id=subject.pk).exclude(event=ev, seat_number__in=seats).delete()
+    current = set(SeatAssignment.objects.filter(subject_id=subject.pk).values_list('seat_number', flat=True))
+    SeatAssignment.objects.bulk_create([
+        SeatAssignment(event=ev, subject_id=subject.pk, seat_number=s) for s in seats if s not in current])
+
+
+def iterate_with_seats(subjects, chunk_size=2000):
+    """
+        Iterate a queryset of subjects with a server side cursor, the seats of each
+        chunk of subjects are fetched with one query
+    """
+    it = subjects.iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(it, chunk_size))
+        if not chunk:
+            return
+        prefetch_related_objects(chunk, 'seat_assignments')
+        yield from chunk
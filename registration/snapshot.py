@@ -0,0 +1,72 @@
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from registration.models import Event, SubjectBase, SubjectExtended
+
+from mysite import settings
+
+CACHE_KEY = 'registration:open-events'
+
+# process local copy of the snapshot, (expiry, events)
+_local = (0, None)
+_lock = threading.Lock()
+stats = {'local_hits': 0, 'hits': 0, 'misses': 0, 'invalidations': 0}
+
+
+def _count(key):
+    with _lock:
+        stats[key] += 1
+
+
+def _snapshot():
+    global _local
+    now = time.monotonic()
+    expiry, events = _local
+    if events is not None and expiry > now:
+        _count('local_hits')
+        return events
+
+    events = cache.get(CACHE_KEY)
+    if events is None:
+        _count('misses')
+        # events that are about to be enabled are part of the snapshot, so that
+        # they show up in time; open_events() checks enable_on and disable_on
+        events = list(Event.objects.filter(is_active=True, disable_on__gte=timezone.now()).order_by('pk'))
+        cache.set(CACHE_KEY, events, settings.EVENTS_CACHE_TIMEOUT)
+    else:
+        _count('hits')
+    _local = (now + settings.EVENTS_CACHE_LOCAL_TIMEOUT, events)
+    return events
+
+
+def open_events():
+    """
+        The events open for registration together with their seat counters, from a cached
+        snapshot. Other processes see changes with a delay of up to EVENTS_CACHE_LOCAL_TIMEOUT.
+    """
+    now = timezone.now()
+    return [ev for ev in _snapshot() if ev.enable_on <= now <= ev.disable_on]
+
+
+def invalidate():
+    global _local
+    _local = (0, None)
+    cache.delete(CACHE_KEY)
+    _count('invalidations')
+
+
+@receiver(post_save, sender=Event)
+@receiver(post_delete, sender=Event)
+@receiver(post_save, sender=SubjectBase)
+@receiver(post_save, sender=SubjectExtended)
+@receiver(post_delete, sender=SubjectBase)
+def invalidate_on_change(sender, **kwargs):
+    invalidate()
+    # a request in between might have cached the state before the commit
+    transaction.on_commit(invalidate)
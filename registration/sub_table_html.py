@@ -0,0 +1,71 @@
+import os
+import tempfile
+
+from django.utils.html import escape
+from django.utils.translation import gettext_lazy as _, ngettext_lazy
+
+HTML_HEAD = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>%(title)s</title>
+<style>
+    @page { size: A4; margin: 1in 0.5in; }
+    body { font-family: sans-serif; font-size: 10pt; }
+    h1 { font-size: 16pt; text-align: center; }
+    table { width: 100%%; border-collapse: collapse; }
+    thead { display: table-header-group; }
+    tr { page-break-inside: avoid; }
+    th { border-bottom: 2px solid black; text-align: left; }
+    td { border-bottom: 1px solid #999; padding: 2px 4px; }
+    td.num, th.num { text-align: right; }
+    td.mark { text-align: center; }
+    td.present { width: 4em; }
+</style>
+</head>
+<body>
+<h1>%(title)s</h1>
+<table>
+<thead><tr>%(header)s</tr></thead>
+<tbody>
+'''
+HTML_TAIL = '''</tbody>
+</table>
+</body>
+</html>
+'''
+ROW = '<tr><td class="num">%i</td><td>%s</td><td>%s</td><td>%s</td><td class="num">%s</td>' \
+      '<td class="mark">%s</td><td class="present"></td></tr>\n'
+# rows are written in chunks, the list is never held in memory as a whole
+CHUNK_SIZE = 1000
+
+
+def create_table(ev, subjects, out_path):
+    """
+        Write the participant list of the event as printable html page to out_path, the
+        same table as the pdf of sub_table_tex without running LaTeX
+    """
+    header = ''.join('<th%s>%s</th>' % (' class="num"' if i in (0, 4) else '', escape(h)) for i, h in enumerate([
+        '', _('name'), _('given_name'), _('email'),
+        ngettext_lazy('seat', 'seats', ev.num_max_per_subject), _('confirmed'), _('present')]))
+
+    fd, tmp_path = tempfile.mkstemp(prefix='table-', suffix='.tmp', dir=os.path.dirname(out_path) or None)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as out_file:
+            out_file.write(HTML_HEAD % dict(title=escape(str(ev)), header=header))
+            rows = []
+            for i, sub in enumerate(subjects):
+                rows.append(ROW % (
+                    i+1, escape(sub.name), escape(sub.given_name), escape(sub.email),
+                    sub.seats if ev.assigned_seats else sub.num_seats,
+                    '&#10004;' if sub.status_confirmed else '&#10008;'))
+                if len(rows) == CHUNK_SIZE:
+                    out_file.writelines(rows)
+                    rows.clear()
+            out_file.writelines(rows)
+            out_file.write(HTML_TAIL)
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return out_path
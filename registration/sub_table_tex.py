@@ -4,8 +4,12 @@ from io import StringIO
 import os
 import string
 import subprocess
+import tempfile
+import threading
 from django.utils.translation import gettext_lazy as _, ngettext_lazy
 
+from mysite import settings
+
 
 LATEX_TEMPLATE = string.Template(
     r'''\documentclass[a4paper]{article}
@@ -67,10 +71,41 @@ def tex_escape(text):
     return regex.sub(lambda match: conv[match.group()], text)
 
 
-def create_table(ev, subjects):
-    project_path = os.path.curdir
-    build_path = os.path.join(project_path, '.build')
-    out_filename = os.path.join(build_path, 'template')
+class TableBuildError(Exception):
+    pass
+
+
+# limits the number of concurrent pdflatex processes of this process
+_pdflatex_slots = threading.BoundedSemaphore(settings.PDFLATEX_MAX_PROCESSES)
+
+
+def run_pdflatex(tex_filename, build_path):
+    """
+        Run pdflatex in build_path, waits for a free slot first
+        :raises TableBuildError: if pdflatex fails or takes longer than PDFLATEX_TIMEOUT
+    """
+    cmd = [settings.PDFLATEX, '-interaction=nonstopmode', '-halt-on-error',
+           '-output-directory', build_path, tex_filename]
+    with _pdflatex_slots:
+        try:
+            proc = subprocess.run(cmd, cwd=build_path, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT, timeout=settings.PDFLATEX_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            raise TableBuildError('pdflatex timed out after %is' % settings.PDFLATEX_TIMEOUT)
+        except OSError as e:
+            raise TableBuildError('unable to run pdflatex: %s' % e)
+    if proc.returncode != 0:
+        log = proc.stdout.decode(errors='replace').splitlines()
+        raise TableBuildError('pdflatex failed with exit code %i:\n%s' % (
+            proc.returncode, '\n'.join(log[-20:])))
+
+
+def create_table(ev, subjects, out_path):
+    """
+        Write the participant list of the event as pdf to out_path. Every call builds in its
+        own temporary directory, the file at out_path is replaced once the build succeeded.
+        :raises TableBuildError: if the build failed
+    """
     documentclass_name = 'article'
 
     options = []
@@ -78,11 +113,8 @@ def create_table(ev, subjects):
         r'\newcommand{\%s}{%s}' % pair for pair in options
     )
     options_latex = ''
-    title = ''
-
-    if len(subjects)>0:
-        title = str(subjects[0].event)
-        seats = subjects[0].event.num_max_per_subject
+    title = tex_escape(str(ev))
+    seats = ev.num_max_per_subject
 
     rows = StringIO()
     for i, sub in enumerate(subjects):
@@ -108,12 +140,15 @@ def create_table(ev, subjects):
         header=header, rows=rows.getvalue(),
     )
 
-    shutil.rmtree(build_path, ignore_errors=True)
+    with tempfile.TemporaryDirectory(prefix='table-') as build_path:
+        out_filename = os.path.join(build_path, 'template')
+        with open(out_filename + '.tex', 'w') as out_file:
+            out_file.write(latex)
 
-    os.makedirs(build_path, exist_ok=True)
-    with open(out_filename + '.tex', 'w') as out_file:
-        out_file.write(latex)
+        run_pdflatex(out_filename + '.tex', build_path)
 
-    subprocess.run(['pdflatex', '-output-directory', build_path, out_filename])
-    # shutil.copy2(out_filename + '.pdf', os.path.dirname(in_filename))
-    return out_filename+'.pdf'
+        # copy next to the destination first, so that the file at out_path is never incomplete
+        tmp_path = '%s.%s.tmp' % (out_path, os.path.basename(build_path))
+        shutil.copy(out_filename + '.pdf', tmp_path)
+        os.replace(tmp_path, out_path)
+    return out_path
@@ -0,0 +1,22 @@
+import django_tables2 as tables
+from django.utils.text import capfirst
+from django.utils.translation import gettext_lazy as _
+
+from registration.models import Subject
+
+
+class SubjectTable(tables.Table):
+    """
+        The subject list of the admin. It shows one page of registration.paging.KeysetPage,
+        only the columns indexed for the keyset pagination can be sorted by.
+    """
+    ORDERINGS = ('reg_date', 'name')
+
+    name = tables.Column(capfirst(_('name')), orderable=True)
+    reg_date = tables.Column(capfirst(_('reg_date')), orderable=True)
+
+    class Meta:
+        model = Subject
+        orderable = False
+        exclude = ('reminder_due_at', 'cancel_due_at', 'search_name', 'search_given_name', 'search_email') + \
+            Subject.CLAIM_FIELDS
@@ -13,10 +13,15 @@ urlpatterns = [
     path('submitted', views.submitted, name='submitted'),
     path('subjects', views.ListSubjectView.as_view(), name='subjects'),
     path('subjects/create', views.CreateSubjectViewAdmin.as_view(), name='subjects-create'),
+    path('subjects/export.csv', views.subject_csv, name='subjects-csv'),
     path('subjects/<slug:pk>', views.SubjectViewAdmin.as_view(), name='subjects-detail'),
     path('events', views.ListEventView.as_view(), name='events'),
     path('events/create', views.CreateEventView.as_view(), name='events-create'),
+    path('events/cache', views.events_cache_stats, name='events-cache'),
+    path('mails/outbox', views.outbox_stats, name='outbox'),
     path('events/<slug:pk>/delete', views.DeleteEventView.as_view(), name='events-delete'),
     path('events/<slug:pk>/participants', views.subject_table, name='events-participants'),
+    path('events/<slug:pk>/participants.csv', views.subject_csv, name='events-participants-csv'),
+    path('events/<slug:pk>/participants/<int:job>', views.subject_table_job, name='events-participants-job'),
     path('events/<slug:pk>', views.EventView.as_view(), name='events-detail'),
 ]
\ No newline at end of file
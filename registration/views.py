@@ -1,10 +1,13 @@
+import csv
 import os
 from django import forms
+from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.exceptions import ValidationError, NON_FIELD_ERRORS
+from django.db.models import Count, Min
 from django.forms import models, ChoiceField
-from django.http import HttpResponse, Http404
-from django.shortcuts import get_object_or_404, render
+from django.http import FileResponse, Http404, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse_lazy, reverse
 from django.utils.safestring import mark_safe
 from django.views import generic
@@ -13,8 +16,15 @@ from django.utils.translation import gettext_lazy as _, ngettext_lazy
 
 from material import Layout, Fieldset, Row, Span2, Span5
 
-from registration.models import Subject, Event
-from registration.sub_table_tex import create_table
+from registration.booking import book, check_capacity
+from registration.exports import request_export
+from registration.models import Subject, Event, ExportJob, OutboxMessage
+from registration.paging import KeysetPage, count_rows
+from registration.search import search
+from registration.seating import iterate_with_seats
+from registration.snapshot import open_events, stats as snapshot_stats
+from registration.tables import SubjectTable
+from registration.wakeup import notify
 
 from mysite import settings
 
@@ -24,28 +34,10 @@ def active_events():
         is_active=True, enable_on__lte=timezone.now(), disable_on__gte=timezone.now())
 
 
-def assign_seats(ev, instance, num_seats):
-    subs = Subject.objects.filter(event=ev).order_by('seats')
-    taken, seats = [], []
-    for s in subs:
-        # don't add subjects seats to list of taken seats, reassign below
-        if instance.pk and s == instance:
-            continue
-        taken.extend(map(int, s.seats.split(',')))
-    # seat numbers start at 1
-    for i in range(1, ev.num_total_seats+1):
-        if i not in taken: seats.append(i)
-        if len(seats) == num_seats:
-            break
-    if len(seats) != num_seats:
-        raise ValidationError("Unable to assign seats", code='invalid')
-    instance.seats = ','.join(map(str, seats))
-
-
 class EventsAvailableMixin:
     def dispatch(self, request, *args, **kwargs):
-        events = active_events()
-        if events.count()==0:
+        events = open_events()
+        if len(events)==0:
             return render(request, 'registration/no_events.html')
 
         if sum([ev.seats_taken<ev.num_total_seats for ev in events]) == 0:
@@ -55,6 +47,16 @@ class EventsAvailableMixin:
 
 
 class CustomModelChoiceIterator(models.ModelChoiceIterator):
+    def __iter__(self):
+        if self.field.events is None:
+            yield from super(CustomModelChoiceIterator, self).__iter__()
+            return
+        # render the choices from the snapshot, the queryset is only used to validate
+        if self.field.empty_label is not None:
+            yield ("", self.field.empty_label)
+        for obj in self.field.events:
+            yield self.choice(obj)
+
     def choice(self, obj):
         return (self.field.prepare_value(obj),
                 '%s%s'%(self.field.label_from_instance(obj),
@@ -62,6 +64,10 @@ class CustomModelChoiceIterator(models.ModelChoiceIterator):
 
 
 class CustomModelChoiceField(models.ModelChoiceField):
+    def __init__(self, *args, events=None, **kwargs):
+        super(CustomModelChoiceField, self).__init__(*args, **kwargs)
+        self.events = events
+
     def _get_choices(self):
         if hasattr(self, '_choices'):
             return self._choices
@@ -118,34 +124,9 @@ class SubjectForm(forms.ModelForm):
                 code='invalid',
                 params={'num_max': ev.num_max_per_subject})
 
-        if self.instance and instance.pk:
-            taken = ev.seats_taken
-
-            # allow subject to decrease registration even if all seats are taken
-            if taken >= ev.num_total_seats:
-                if self.cleaned_data['num_seats'] > instance.num_seats:
-                    raise ValidationError(_('no_seats_event'), code='invalid')
-            # if not all seats are taken, allow subject to fill up seats up to num_total_seats
-            elif taken-instance.num_seats+self.cleaned_data['num_seats'] > ev.num_total_seats:
-                raise ValidationError(ngettext_lazy(
-                    'max_seats_exceeded_%(num_free)i',
-                    'max_seats_exceeded_pl_%(num_free)i',
-                    ev.num_total_seats-taken), code='invalid', params={'num_free': ev.num_total_seats-taken})
-
-        else:
-            taken = ev.seats_taken
-            # it is not possible to create a registration when there are no more seats available
-            if taken >= ev.num_total_seats:
-                raise ValidationError(_('no_seats_event'), code='invalid')
-
-            # it is not possible to exceed the number of available seats
-            if taken+self.cleaned_data['num_seats'] > ev.num_total_seats:
-                raise ValidationError(ngettext_lazy(
-                    'max_seats_exceeded_%(num_free)i',
-                    'max_seats_exceeded_pl_%(num_free)i',
-                    ev.num_total_seats-taken), code='invalid', params={'num_free': ev.num_total_seats-taken})
-
-        assign_seats(ev, instance, self.cleaned_data['num_seats'])
+        # check early for a friendly error message, book() checks again with the event locked
+        check_capacity(ev, self.cleaned_data['num_seats'],
+                       instance.num_seats if self.instance and instance.pk else 0)
         return self.cleaned_data['num_seats']
 
     class Meta:
@@ -175,18 +156,6 @@ class SubjectFormCreate(SubjectForm):
 
 
 class SubjectFormAdmin(forms.ModelForm):
-    def clean_num_seats(self):
-        instance = getattr(self, 'instance', None)
-        if self.instance and instance.pk:
-            ev = self.instance.event
-        else:
-            if not self.data['event']:
-                return self.cleaned_data['num_seats']
-            ev = self.cleaned_data['event']
-
-        assign_seats(ev, instance, self.cleaned_data['num_seats'])
-        return self.cleaned_data['num_seats']
-
     class Meta:
         model = Subject
         fields = ['name', 'given_name', 'email', 'event', 'num_seats',
@@ -194,7 +163,22 @@ class SubjectFormAdmin(forms.ModelForm):
                   'reminder_sent', 'confirmation_sent']
 
 
-class CreateSubjectView(EventsAvailableMixin, generic.CreateView):
+class BookingMixin:
+    # admins may book beyond the capacity of an event
+    check_capacity = True
+
+    def form_valid(self, form):
+        try:
+            self.object = book(form, check=self.check_capacity)
+        except ValidationError as e:
+            form.add_error('num_seats', e)
+            return self.form_invalid(form)
+        # the mailer sends the mails of new and confirmed registrations right away
+        notify()
+        return HttpResponseRedirect(self.get_success_url())
+
+
+class CreateSubjectView(EventsAvailableMixin, BookingMixin, generic.CreateView):
     form_class = SubjectFormCreate
     template_name = 'registration/subject_form_create.html'
     success_url = reverse_lazy('submitted')
@@ -203,19 +187,21 @@ class CreateSubjectView(EventsAvailableMixin, generic.CreateView):
         context = super(CreateSubjectView, self).get_context_data(**kwargs)
         context['form'].fields['event'] = CustomModelChoiceField(
             widget = forms.Select,
-            queryset = active_events()
+            queryset = active_events(),
+            events = open_events()
         )
         return context
 
 
-class SubjectView(generic.UpdateView):
+class SubjectView(BookingMixin, generic.UpdateView):
     model = Subject
     slug_field = 'token'
     form_class = SubjectForm
     template_name = 'registration/subject_form.html'
 
 
-class SubjectViewAdminBase(LoginRequiredMixin):
+class SubjectViewAdminBase(LoginRequiredMixin, BookingMixin):
+    check_capacity = False
     model = Subject
     form_class = SubjectFormAdmin
     success_url = reverse_lazy('subjects')
@@ -237,6 +223,7 @@ def confirm(request, token):
     sub = get_object_or_404(Subject.objects.filter(token=token))
     sub.status_confirmed = True
     sub.save()
+    notify()
     return render(request, 'registration/confirm.html', {'subject': sub, 'event': sub.event})
 
 
@@ -252,33 +239,57 @@ class FilterForm(forms.Form):
         queryset=Event.objects.all(),
         empty_label="(All)",
         widget=forms.Select(attrs={"onChange":'filter(this)'}))
+    # name, given name, email or token, see registration.search
+    q = forms.CharField(label='Search', required=False)
 
 
 class ListSubjectView(LoginRequiredMixin, generic.ListView):
     model = Subject
+    # the table shows the event of every subject
+    queryset = Subject.objects.select_related('event')
     template_name = 'registration/subject_list.html'
 
     def get_queryset(self):
+        queryset = super(ListSubjectView, self).get_queryset()
         filter_val = self.request.GET.get('event', None)
-        if filter_val is None:
-            return super(ListSubjectView, self).get_queryset()
-
-        queryset = Subject.objects.filter(event=filter_val)
-
-        ordering = self.get_ordering()
-        if ordering:
-            if isinstance(ordering, str):
-                ordering = (ordering,)
-            queryset = queryset.order_by(*ordering)
-
-        return queryset
+        if filter_val:
+            queryset = queryset.filter(event=filter_val)
+        return search(queryset, self.request.GET.get('q', ''))
+
+    def get_ordering(self):
+        # sorted by the database, only by columns with an index for the keyset pagination
+        ordering = self.request.GET.get('sort', 'reg_date')
+        if ordering.lstrip('-') not in SubjectTable.ORDERINGS:
+            return 'reg_date'
+        return ordering
+
+    def page_url(self, **params):
+        query = self.request.GET.copy()
+        for key in ('after', 'before'):
+            query.pop(key, None)
+        for key, value in params.items():
+            query[key] = value
+        return '?%s' % query.urlencode()
 
     def get_context_data(self, **kwargs):
         context = super(ListSubjectView, self).get_context_data(**kwargs)
         context['filter'] = FilterForm()
         filter_val = self.request.GET.get('event', None)
-        if filter_val is not None:
+        if filter_val:
             context['filter'].fields['event'].initial = Event.objects.filter(id=filter_val).first()
+        context['filter'].fields['q'].initial = self.request.GET.get('q', '')
+
+        ordering = self.get_ordering()
+        page = KeysetPage(self.object_list, ordering, settings.SUBJECTS_PER_PAGE,
+                          after=self.request.GET.get('after'), before=self.request.GET.get('before'))
+        context['page'] = page
+        context['table'] = SubjectTable(page.object_list, order_by=ordering)
+        context['count'], context['count_estimated'] = count_rows(self.object_list)
+        context['first_url'] = self.page_url()
+        if page.previous_cursor:
+            context['previous_url'] = self.page_url(before=page.previous_cursor)
+        if page.next_cursor:
+            context['next_url'] = self.page_url(after=page.next_cursor)
         return context
 
 
@@ -304,13 +315,17 @@ class CreateEventView(EventViewBase, generic.CreateView):
 
 
 class EventForm(forms.ModelForm):
+    # the seat counters are not editable model fields, show them read-only
     seats_taken = forms.CharField(disabled=True, required=False)
+    field_order = ['title', 'date', 'is_active', 'enable_on',
+        'disable_on', 'num_total_seats', 'num_max_per_subject',
+        'assigned_seats', 'seats_taken', 'reminder_hours', 'hold_back_hours']
 
     class Meta:
         model = Event
         fields = ['title', 'date', 'is_active', 'enable_on', 
         'disable_on', 'num_total_seats', 'num_max_per_subject', 
-        'assigned_seats', 'seats_taken', 'reminder_hours', 'hold_back_hours']
+        'assigned_seats', 'reminder_hours', 'hold_back_hours']
 
 
 class EventView(EventViewBase, generic.UpdateView):
@@ -329,13 +344,93 @@ class DeleteEventView(EventViewBase, generic.DeleteView):
     pass
 
 
+@login_required
+def events_cache_stats(request):
+    # counters of this process only
+    return JsonResponse(snapshot_stats)
+
+
+@login_required
+def outbox_stats(request):
+    stats = {status: 0 for status, label in OutboxMessage.STATUS_CHOICES}
+    stats.update(OutboxMessage.objects.values_list('status').annotate(Count('pk')).order_by())
+    oldest = OutboxMessage.objects.filter(status=OutboxMessage.PENDING).aggregate(Min('created'))['created__min']
+    stats['oldest_pending_seconds'] = (timezone.now() - oldest).total_seconds() if oldest else None
+    return JsonResponse(stats)
+
+
+def _export_response(job):
+    content_type = 'text/html; charset=utf-8' if job.format == 'html' else 'application/pdf'
+    response = FileResponse(open(job.file_path, 'rb'), content_type=content_type)
+    response['Content-Disposition'] = 'inline; filename=participants-%i.%s' % (job.event_id, job.format)
+    return response
+
+
+@login_required
 def subject_table(request, pk):
     event = get_object_or_404(Event.objects.filter(pk=pk))
-    subs = Subject.objects.filter(event=event).order_by('name', 'given_name', 'email')
-    file_path = create_table(event, subs)
-    if os.path.exists(file_path):
-        with open(file_path, 'rb') as fh:
-            response = HttpResponse(fh.read(), content_type="application/pdf")
-            response['Content-Disposition'] = 'inline; filename=' + os.path.basename(file_path)
-            return response
-    raise Http404
+    job = request_export(event)
+    # unchanged lists are served right away, otherwise wait for the build on the status page
+    if job.status == ExportJob.DONE:
+        return _export_response(job)
+    return redirect(job)
+
+
+@login_required
+def subject_table_job(request, pk, job):
+    job = get_object_or_404(ExportJob.objects.select_related('event').filter(pk=job, event=pk))
+    if request.GET.get('format') == 'json':
+        return JsonResponse(dict(status=job.status, error=job.error))
+    if job.status == ExportJob.DONE and os.path.exists(job.file_path):
+        return _export_response(job)
+    return render(request, 'registration/export_status.html', {'job': job})
+
+
+CSV_FIELDS = ['id', 'event', 'name', 'given_name', 'email', 'reg_date', 'num_seats', 'seats',
+              'status_confirmed', 'confirmation_request_sent', 'reminder_sent', 'confirmation_sent']
+if settings.SUBJECT_CLASS == 'SubjectExtended':
+    CSV_FIELDS.extend(['phone', 'address', 'post_code', 'city'])
+
+
+class _Echo:
+    """file like object that returns what is written instead of storing it"""
+    def write(self, value):
+        return value
+
+
+def _csv_rows(subjects):
+    yield CSV_FIELDS
+    events = {}
+    for sub in iterate_with_seats(subjects.select_related('event')):
+        if sub.event_id not in events:
+            events[sub.event_id] = str(sub.event)
+        values = dict(event=events[sub.event_id], reg_date=timezone.localtime(sub.reg_date).isoformat())
+        yield [values[f] if f in values else getattr(sub, f) for f in CSV_FIELDS]
+
+
+@login_required
+def subject_csv(request, pk=None):
+    """
+        Stream the registrations of one event, or of all events if none is given, as csv.
+        The subjects are read with a server side cursor, so memory usage doesn't grow with their number.
+    """
+    pk = pk or request.GET.get('event', None)
+    if pk is not None:
+        # the pk of the url is a slug, the one of the query string anything
+        try:
+            pk = int(pk)
+        except ValueError:
+            raise Http404('invalid event')
+        # larger ones overflow the integers of the database
+        if not 0 < pk < 2**63:
+            raise Http404('invalid event')
+    subjects = Subject.objects.order_by('event', 'name', 'given_name', 'email')
+    if pk is not None:
+        subjects = subjects.filter(event=get_object_or_404(Event.objects.filter(pk=pk)))
+
+    writer = csv.writer(_Echo())
+    response = StreamingHttpResponse((writer.writerow(row) for row in _csv_rows(subjects)),
+                                     content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename=%s.csv' % (
+        'participants-%s' % pk if pk is not None else 'participants')
+    return response
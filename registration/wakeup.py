@@ -0,0 +1,88 @@
+import os
+import select
+import time
+
+from django.db import connection, transaction
+
+from mysite import settings
+
+CHANNEL = 'registration_mailer'
+
+
+def notify():
+    """
+        Wake up the mailers once the current transaction is committed
+    """
+    transaction.on_commit(_notify)
+
+
+def _notify():
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('NOTIFY %s' % CHANNEL)
+        return
+    # without LISTEN/NOTIFY, the mailers watch the modification time of a file
+    try:
+        os.makedirs(os.path.dirname(settings.MAIL_WAKEUP_FILE), exist_ok=True)
+        with open(settings.MAIL_WAKEUP_FILE, 'a'):
+            os.utime(settings.MAIL_WAKEUP_FILE)
+    except OSError as e:
+        # the mailer still finds the work when it polls the next time
+        print('unable to wake up the mailer: %s' % e)
+
+
+class Waiter(object):
+    """
+        Waits for notify() or until the polling interval is over. The interval starts with
+        MAIL_POLL_MIN and is doubled for every wait without notification, up to MAIL_POLL_MAX.
+    """
+    # seconds between two looks at MAIL_WAKEUP_FILE
+    FILE_CHECK_INTERVAL = 0.1
+
+    def __init__(self):
+        self.timeout = settings.MAIL_POLL_MIN
+        self._listening = None
+        self._mtime = self._file_mtime()
+
+    def wait(self):
+        """
+            :return: True if woken up by notify()
+        """
+        if connection.vendor == 'postgresql':
+            woken = self._wait_postgresql(self.timeout)
+        else:
+            woken = self._wait_file(self.timeout)
+        self.timeout = settings.MAIL_POLL_MIN if woken else min(2 * self.timeout, settings.MAIL_POLL_MAX)
+        return woken
+
+    def _wait_postgresql(self, timeout):
+        connection.ensure_connection()
+        # the psycopg2 connection, LISTEN has to be repeated for a new one
+        raw = connection.connection
+        if self._listening is not raw:
+            with connection.cursor() as cursor:
+                cursor.execute('LISTEN %s' % CHANNEL)
+            self._listening = raw
+        if not raw.notifies:
+            select.select([raw], [], [], timeout)
+            raw.poll()
+        woken = len(raw.notifies) > 0
+        del raw.notifies[:]
+        return woken
+
+    def _file_mtime(self):
+        try:
+            return os.stat(settings.MAIL_WAKEUP_FILE).st_mtime_ns
+        except OSError:
+            return None
+
+    def _wait_file(self, timeout):
+        end = time.monotonic() + timeout
+        while True:
+            mtime = self._file_mtime()
+            if mtime != self._mtime:
+                self._mtime = mtime
+                return True
+            if time.monotonic() >= end:
+                return False
+            time.sleep(min(self.FILE_CHECK_INTERVAL, max(0, end - time.monotonic())))
@@ -1,19 +1,66 @@
 import os
+import re
+import atexit
+import csv
+import asyncio
+import smtplib
 import datetime
+import tempfile
+import threading
+import time
 import mailing
 import names
 
+from asgiref.sync import sync_to_async
+from io import StringIO
+from unittest import mock
+from django.db import connection, transaction, IntegrityError, OperationalError
+from django.contrib.auth.models import User
 from django.core import mail
-from django.test import TestCase
+from django.core.mail.backends import locmem
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db.models import Sum
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, modify_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 
-from registration.models import Subject, Event
+from registration.models import Subject, SubjectBase, Event, SeatAssignment, ExportJob, OutboxMessage, MailRelayBucket, \
+    recount_seats
+from registration import booking
+from registration import exports
+from registration.sub_table_tex import create_table, TableBuildError
+from registration.seating import SeatMap
+from registration import snapshot
+from registration import mails
+from registration.expiry import expire_registrations
+from registration.ratelimit import TokenBucket, RelayPool
+from registration import wakeup
+from mysite import settings, timing
 
-mailing.DEADTIME = 0
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
 
+    def time(self):
+        return self.now
 
-class SubjectTestCase(TestCase):
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+# the mailer doesn't wait for the rate limit in the tests
+clock = FakeClock()
+mailing.relays = RelayPool(settings.MAIL_RELAYS, clock=clock.time, sleep=clock.sleep)
+# keep the files of the mailer out of the project
+mail_dir = tempfile.TemporaryDirectory(prefix='mailing-')
+atexit.register(mail_dir.cleanup)
+mailing.MAIL_LOCK_FILE = os.path.join(mail_dir.name, 'mailing.lock')
+settings.MAIL_WAKEUP_FILE = os.path.join(mail_dir.name, 'mailing.wakeup')
+
+
+class RegistrationTestCase(TestCase):
     def setUp(self):
         self.ev = Event.objects.create(
             title='Test',
@@ -22,6 +69,10 @@ class SubjectTestCase(TestCase):
             disable_on=timezone.now() + datetime.timedelta(days=1),
         )
 
+    def login_admin(self, **kwargs):
+        User.objects.create_user('admin', password='admin', **kwargs)
+        self.client.login(username='admin', password='admin')
+
     def create_subject(self):
         name = names.get_full_name().split()
         email = '%s@test.com' % '.'.join(map(str.lower, name))
@@ -32,6 +83,8 @@ class SubjectTestCase(TestCase):
             event=self.ev,
         )
 
+
+class SubjectTestCase(RegistrationTestCase):
     def test_mailing(self):
         for i in range(20):
             subj = self.create_subject()
@@ -80,11 +133,13 @@ class SubjectTestCase(TestCase):
 
             if i % 2:
                 Subject.objects.filter(email=email).delete()
+        self.ev.refresh_from_db()
         print(self.ev.seats_taken)
 
     def test_create(self):
         self.assertEqual(self.ev.seats_taken, 0)
         self.create_subject()
+        self.ev.refresh_from_db()
         self.assertEqual(self.ev.seats_taken, 1)
 
     def test_confirm(self):
@@ -106,6 +161,7 @@ class SubjectTestCase(TestCase):
             reverse('subject-modify', kwargs={'slug': subj.token}), data=data)
         self.assertEqual(response.status_code, 302)
         self.assertTrue(response.url.startswith(os.path.join('/', subj.token, 'modify')))
+        self.ev.refresh_from_db()
         self.assertEqual(self.ev.seats_taken, 2)
 
     def test_delete(self):
@@ -117,4 +173,1179 @@ class SubjectTestCase(TestCase):
         self.assertEqual(response.status_code, 302)
         self.assertTrue(response.url.startswith('/'))
         self.assertEqual(Subject.objects.filter(pk=subj.pk).count(), 0)
+        self.ev.refresh_from_db()
         self.assertEqual(self.ev.seats_taken, 0)
+
+
+class SeatCounterTestCase(RegistrationTestCase):
+    def assertCountersConsistent(self):
+        for ev in Event.objects.all():
+            subs = Subject.objects.filter(event=ev)
+            self.assertEqual(ev.seats_taken, subs.aggregate(s=Sum('num_seats'))['s'] or 0)
+            self.assertEqual(ev.confirmed_seats,
+                             subs.filter(status_confirmed=True).aggregate(s=Sum('num_seats'))['s'] or 0)
+
+    def test_counters(self):
+        subs = [self.create_subject() for i in range(10)]
+        self.assertCountersConsistent()
+
+        subs[0].num_seats = 3
+        subs[0].save()
+        self.client.get(reverse('subject-confirm', kwargs={'token': subs[1].token}))
+        self.client.get(reverse('subject-confirm', kwargs={'token': subs[1].token}))
+        self.client.post(reverse('subject-delete', kwargs={'slug': subs[2].token}))
+        subs[3].delete()
+        Subject.objects.filter(pk__in=[s.pk for s in subs[4:6]]).delete()
+        self.assertCountersConsistent()
+        self.ev.refresh_from_db()
+        self.assertEqual((self.ev.seats_taken, self.ev.confirmed_seats), (8, 1))
+
+    def test_event_save_keeps_counters(self):
+        ev = Event.objects.get(pk=self.ev.pk)
+        self.create_subject()
+        ev.title = 'Changed'
+        ev.save()
+        self.assertCountersConsistent()
+
+    def test_admin_move_subject(self):
+        other = Event.objects.create(title='Other', num_total_seats=20)
+        subj = self.create_subject()
+        self.login_admin()
+        response = self.client.post(
+            reverse('subjects-detail', kwargs={'pk': subj.pk}),
+            data=dict(name=subj.name, given_name=subj.given_name, email=subj.email,
+                      event=other.pk, num_seats=4, status_confirmed=True))
+        self.assertEqual(response.status_code, 302)
+        self.assertCountersConsistent()
+        other.refresh_from_db()
+        self.assertEqual((other.seats_taken, other.confirmed_seats), (4, 4))
+
+    def test_booking_retry(self):
+        save_seats = booking.save_seats
+        attempts = []
+
+        def locked_once(ev, subject, seats):
+            # the subject row is inserted when the first attempt fails
+            attempts.append((subject.pk, subject._state.adding))
+            if len(attempts) == 1:
+                raise OperationalError('database is locked')
+            return save_seats(ev, subject, seats)
+
+        with mock.patch.object(booking, 'save_seats', side_effect=locked_once), \
+                mock.patch.object(booking, 'RETRY_DELAY', 0):
+            response = self.client.post(reverse('index'), data=dict(
+                name='Name', given_name='Given', email='retry@test.com', event=self.ev.pk,
+                num_seats=2, privacy=True))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(len(attempts), 2)
+        subj = Subject.objects.get(email='retry@test.com')
+        self.assertEqual(attempts[1][0], subj.pk)
+        self.assertEqual(Subject.objects.count(), 1)
+        self.assertCountersConsistent()
+        self.ev.refresh_from_db()
+        self.assertEqual(self.ev.seats_taken, 2)
+
+    def test_recount_seats(self):
+        for i in range(3):
+            self.create_subject()
+        Event.objects.filter(pk=self.ev.pk).update(seats_taken=42, confirmed_seats=7)
+        out = StringIO()
+        call_command('recount_seats', stdout=out)
+        self.assertIn('1 event(s) corrected', out.getvalue())
+        self.assertCountersConsistent()
+
+
+class SeatAssignmentTestCase(RegistrationTestCase):
+    def setUp(self):
+        super(SeatAssignmentTestCase, self).setUp()
+        self.ev.assigned_seats = True
+        self.ev.save()
+
+    def register(self, num_seats):
+        email = '%s@test.com' % names.get_first_name().lower()
+        self.client.post(reverse('index'), data=dict(
+            name='Name', given_name='Given', email=email, event=self.ev.pk, num_seats=num_seats, privacy=True))
+        return Subject.objects.get(event=self.ev, email=email)
+
+    def test_assign(self):
+        first, second = self.register(2), self.register(3)
+        self.assertEqual(first.seat_numbers, [1, 2])
+        self.assertEqual(second.seats, '3,4,5')
+
+        response = self.client.post(reverse('subject-modify', kwargs={'slug': first.token}), data=dict(
+            name=first.name, given_name=first.given_name, num_seats=4))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(first.seat_numbers, [6, 7, 8, 9])
+
+        self.client.post(reverse('subject-delete', kwargs={'slug': second.token}))
+        self.assertEqual(SeatAssignment.objects.filter(event=self.ev).count(), 4)
+
+    def test_unique_seat(self):
+        subj = self.register(1)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            SeatAssignment.objects.create(event=self.ev, subject=self.create_subject(), seat_number=subj.seat_numbers[0])
+
+
+class SnapshotTestCase(RegistrationTestCase):
+    def test_open_events(self):
+        snapshot.invalidate()
+        self.client.get(reverse('index'))
+        misses = snapshot.stats['misses']
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('index'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(snapshot.stats['misses'], misses)
+
+        # a booking invalidates the snapshot
+        self.ev.num_total_seats = 1
+        self.ev.save()
+        self.create_subject()
+        response = self.client.get(reverse('index'))
+        self.assertEqual(snapshot.stats['misses'], misses+1)
+        self.assertTemplateUsed(response, template_name='registration/no_seats.html')
+
+        self.login_admin()
+        self.assertEqual(self.client.get(reverse('events-cache')).json()['misses'], misses+1)
+
+    def test_not_yet_open(self):
+        Event.objects.filter(pk=self.ev.pk).update(enable_on=timezone.now() + datetime.timedelta(hours=1))
+        snapshot.invalidate()
+        response = self.client.get(reverse('index'))
+        self.assertTemplateUsed(response, template_name='registration/no_events.html')
+
+
+class QueryCountTestCase(RegistrationTestCase):
+    def add_events(self, num_events, num_subjects):
+        for i in range(num_events):
+            self.ev = Event.objects.create(
+                title='Test %i' % i, num_total_seats=100,
+                enable_on=timezone.now() - datetime.timedelta(days=1),
+                disable_on=timezone.now() + datetime.timedelta(days=1))
+            for j in range(num_subjects):
+                self.create_subject()
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def test_index_page(self):
+        # fetching the snapshot is the only query
+        snapshot.invalidate()
+        with self.assertNumQueries(1):
+            self.client.get(reverse('index'))
+        self.add_events(5, 10)
+        snapshot.invalidate()
+        with self.assertNumQueries(1):
+            self.client.get(reverse('index'))
+
+    def test_confirmation_mails(self):
+        # the seats of the subjects are prefetched with the batch
+        Event.objects.filter(pk=self.ev.pk).update(assigned_seats=True)
+        self.ev.refresh_from_db()
+
+        def count_mail_queries(num_subjects):
+            for i in range(num_subjects):
+                subj = self.create_subject()
+                SeatAssignment.objects.create(event=self.ev, subject=subj, seat_number=subj.pk)
+            Subject.objects.update(status_confirmed=True)
+            with CaptureQueriesContext(connection) as ctx:
+                mailing.handle_confirmed_subjects()
+            self.assertEqual(OutboxMessage.objects.filter(kind='confirmation').count(), num_subjects)
+            OutboxMessage.objects.all().delete()
+            return len(ctx.captured_queries)
+
+        self.assertEqual(count_mail_queries(2), count_mail_queries(6))
+
+    def test_subject_list(self):
+        self.login_admin()
+        self.add_events(1, 1)
+        num_queries = self.count_queries(reverse('subjects'))
+        self.add_events(3, 10)
+        self.assertEqual(self.count_queries(reverse('subjects')), num_queries)
+
+
+class SubjectListTestCase(RegistrationTestCase):
+    def setUp(self):
+        super(SubjectListTestCase, self).setUp()
+        self.login_admin()
+        now = timezone.now()
+        # equal names and dates, the pages have to be split within them
+        for i in range(7):
+            Subject.objects.create(name='Name%i' % (i % 3), given_name='Given', email='%i@test.com' % i,
+                                   event=self.ev, reg_date=now - datetime.timedelta(hours=i % 2))
+        patcher = mock.patch.object(settings, 'SUBJECTS_PER_PAGE', 3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def pages(self, url, key='next_url'):
+        response = self.client.get(url)
+        pages = []
+        while True:
+            self.assertEqual(response.status_code, 200)
+            pages.append([sub.pk for sub in response.context['page'].object_list])
+            if key not in response.context:
+                return pages, response
+            response = self.client.get(reverse('subjects') + response.context[key])
+
+    def test_pages(self):
+        expected = list(Subject.objects.order_by('reg_date', 'pk').values_list('pk', flat=True))
+        pages, last = self.pages(reverse('subjects'))
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertEqual(sum(pages, []), expected)
+        self.assertEqual(last.context['count'], 7)
+        # and back again
+        pages, first = self.pages(reverse('subjects') + last.context['previous_url'], 'previous_url')
+        self.assertEqual(sum(reversed(pages), []), expected[:6])
+        self.assertFalse(first.context['page'].has_previous)
+
+    def test_sorting(self):
+        expected = list(Subject.objects.order_by('-name', '-pk').values_list('pk', flat=True))
+        pages, last = self.pages(reverse('subjects') + '?sort=-name')
+        self.assertEqual(sum(pages, []), expected)
+        # only indexed columns
+        response = self.client.get(reverse('subjects') + '?sort=email')
+        self.assertEqual(response.context['page'].ordering, 'reg_date')
+
+    def test_event_filter(self):
+        ev = Event.objects.create(title='Other', num_total_seats=100)
+        Subject.objects.create(name='Other', given_name='Given', email='other@test.com', event=ev)
+        pages, last = self.pages(reverse('subjects') + '?event=%i' % self.ev.pk)
+        self.assertEqual(len(sum(pages, [])), 7)
+        self.assertEqual(last.context['count'], 7)
+        self.assertIn('event=%i' % self.ev.pk, last.context['first_url'])
+
+    def test_invalid_cursor(self):
+        first = self.client.get(reverse('subjects'))
+        # tampered with or of another ordering
+        for query in ('?after=invalid', '?sort=name&' + first.context['next_url'][1:]):
+            response = self.client.get(reverse('subjects') + query)
+            self.assertFalse(response.context['page'].has_previous)
+            self.assertEqual(len(response.context['page'].object_list), 3)
+
+
+class SearchTestCase(RegistrationTestCase):
+    def setUp(self):
+        super(SearchTestCase, self).setUp()
+        self.login_admin()
+        self.other = Event.objects.create(title='Other', num_total_seats=100)
+        self.mueller = Subject.objects.create(name='Müller', given_name='Anna', email='anna.m@test.com', event=self.ev)
+        self.meyer = Subject.objects.create(name='Meyer', given_name='Hans', email='hans@test.com', event=self.ev)
+        self.hans = Subject.objects.create(name='Hansen', given_name='Jens', email='jh@test.com', event=self.other)
+
+    def found(self, query, **params):
+        params['q'] = query
+        response = self.client.get(reverse('subjects'), params)
+        self.assertEqual(response.status_code, 200)
+        return set(response.context['page'].object_list)
+
+    def test_search(self):
+        self.assertEqual(self.found('mül'), {self.mueller})
+        self.assertEqual(self.found('ANNA'), {self.mueller})
+        self.assertEqual(self.found('hans'), {self.meyer, self.hans})
+        self.assertEqual(self.found('hans meyer'), {self.meyer})
+        self.assertEqual(self.found('jh@'), {self.hans})
+        self.assertEqual(self.found(self.meyer.token[:8]), {self.meyer})
+        self.assertEqual(self.found('nobody'), set())
+        self.assertEqual(self.found('  '), {self.mueller, self.meyer, self.hans})
+
+    def test_last_char(self):
+        # the upper ends of the ranges skip the surrogates, and stay at the last codepoint
+        Subject.objects.create(name='Ab\ud7ff', given_name='Edge', email='edge@test.com', event=self.ev)
+        self.assertEqual(len(self.found('ab\ud7ff')), 1)
+        self.assertEqual(self.found('ab\U0010ffff'), set())
+
+    def test_event_filter(self):
+        self.assertEqual(self.found('hans', event=self.ev.pk), {self.meyer})
+        self.assertEqual(self.found('hans', event=''), {self.meyer, self.hans})
+
+    def test_renamed(self):
+        self.meyer.name = 'Schmidt'
+        self.meyer.save()
+        self.assertEqual(self.found('meyer'), set())
+        self.assertEqual(self.found('schmi'), {self.meyer})
+
+
+class QueryPlanTestCase(RegistrationTestCase):
+    """
+        The hot queries have to search an index, a full scan of the registrations or the outbox,
+        also along an index, means that one is missing
+    """
+    TABLES = '|'.join(sorted({Subject._meta.db_table, SubjectBase._meta.db_table, OutboxMessage._meta.db_table}))
+    SCANS = {
+        # a full scan of the table, or of one of its indexes for the order of the rows
+        'sqlite': re.compile(r'^SCAN (TABLE )?(%s)\b' % TABLES),
+        'postgresql': re.compile(r'(Seq Scan|Index Scan|Index Only Scan)( Backward)? (using \S+ )?on (%s)\b' % TABLES),
+    }
+    INDEX_SCANS = {
+        'sqlite': re.compile(r' USING (COVERING )?INDEX '),
+        'postgresql': re.compile(r'Index (Only )?Scan'),
+    }
+
+    def setUp(self):
+        super(QueryPlanTestCase, self).setUp()
+        if connection.vendor not in self.SCANS:
+            self.skipTest('no query plans for %s' % connection.vendor)
+        self.login_admin()
+        for i in range(10):
+            self.create_subject()
+
+    def plan(self, sql):
+        """
+            :return: the nodes of the plan of the statement, each with its conditions on PostgreSQL
+        """
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # the tables of the tests are tiny, make the planner use an index whenever there is one
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute('EXPLAIN ' + sql)
+                nodes = []
+                for row in cursor.fetchall():
+                    if not nodes or row[0].lstrip().startswith('->'):
+                        nodes.append(row[0])
+                    else:
+                        nodes[-1] += '\n' + row[0]
+                return nodes
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def full_scans(self, sql):
+        # walking a whole index is only fine for the first rows of an unfiltered query
+        first_rows = re.search(r'\bLIMIT\b', sql) and not re.search(r'\bWHERE\b', sql)
+        for node in self.plan(sql):
+            if not self.SCANS[connection.vendor].search(node):
+                continue
+            if self.INDEX_SCANS[connection.vendor].search(node) and 'Index Cond' in node:
+                continue
+            if self.INDEX_SCANS[connection.vendor].search(node) and first_rows:
+                continue
+            yield node
+
+    def assertIndexed(self, func, *args):
+        with CaptureQueriesContext(connection) as ctx:
+            func(*args)
+        statements = [query['sql'] for query in ctx.captured_queries
+                      if query['sql'].split(None, 1)[0].upper() in ('SELECT', 'UPDATE', 'DELETE')
+                      and re.search(r'\b(%s)\b' % self.TABLES, query['sql'])]
+        self.assertTrue(statements)
+        for sql in statements:
+            self.assertEqual(list(self.full_scans(sql)), [], sql)
+
+    def test_full_scans(self):
+        # no index on the filter, the one of the order walks the whole table
+        unindexed = Subject.objects.filter(num_seats=2).order_by('reg_date')[:3]
+        self.assertTrue(list(self.full_scans(str(unindexed.query))))
+        self.assertFalse(list(self.full_scans(str(Subject.objects.order_by('reg_date')[:3].query))))
+        self.assertFalse(list(self.full_scans(str(Subject.objects.filter(pk=1).query))))
+
+    def test_token_lookups(self):
+        sub = Subject.objects.first()
+        for name in ('subject-confirm', 'subject-modify', 'subject-delete'):
+            self.assertIndexed(self.client.get, reverse(name, args=[sub.token]))
+
+    def test_mailer(self):
+        self.assertIndexed(mailing.enqueue_due_mails)
+        self.assertIndexed(mailing.drain_outbox)
+        Subject.objects.update(reg_date=timezone.now() - datetime.timedelta(days=10))
+        for sub in Subject.objects.all()[:5]:
+            sub.save()
+        self.assertIndexed(mailing.enqueue_due_mails)
+        Subject.objects.update(reminder_sent=True)
+        self.assertIndexed(expire_registrations)
+        self.assertIndexed(mailing.purge_outbox)
+
+    def test_seat_counters(self):
+        self.assertIndexed(recount_seats, Event.objects.filter(pk=self.ev.pk))
+
+    @mock.patch.object(settings, 'SUBJECTS_PER_PAGE', 3)
+    def test_subject_list(self):
+        first = self.client.get(reverse('subjects'), {'event': self.ev.pk, 'sort': '-name'})
+        for params in ({'event': self.ev.pk, 'sort': '-name'}, {'sort': 'reg_date', 'q': 'a'}):
+            self.assertIndexed(self.client.get, reverse('subjects'), params)
+        self.assertIndexed(self.client.get, reverse('subjects') + first.context['next_url'])
+
+
+@modify_settings(MIDDLEWARE={'prepend': 'mysite.timing.request_timing_middleware'})
+class RequestTimingTestCase(RegistrationTestCase):
+    def setUp(self):
+        super(RequestTimingTestCase, self).setUp()
+        timing.stats.clear()
+
+    def test_server_timing(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('index'))
+        header = re.match(r'total;dur=([\d.]+), db;dur=([\d.]+);desc="(\d+) queries", tpl;dur=([\d.]+)$',
+                          response['Server-Timing'])
+        self.assertIsNotNone(header)
+        total, db, queries, template = header.groups()
+        self.assertEqual(int(queries), len(ctx.captured_queries))
+        self.assertGreater(float(template), 0)
+        self.assertLessEqual(float(db) + float(template), float(total))
+
+        stats = timing.stats['index']
+        self.assertEqual(stats['requests'], 1)
+        self.assertEqual(stats['queries'], len(ctx.captured_queries))
+        self.assertEqual(stats['size'], len(response.content))
+        self.assertEqual(sum(stats['histogram']), 1)
+
+    def test_stats(self):
+        for i in range(3):
+            self.client.get(reverse('index'))
+        self.client.get('/no/such/page')
+        # staff only
+        User.objects.create_user('user', password='user')
+        self.client.login(username='user', password='user')
+        self.assertEqual(self.client.get(reverse('timing')).status_code, 302)
+        self.login_admin(is_staff=True)
+        stats = self.client.get(reverse('timing')).json()
+        self.assertEqual(stats['index']['requests'], 3)
+        self.assertEqual(sum(stats['index']['histogram'].values()), 3)
+        self.assertEqual(stats['unresolved']['requests'], 1)
+
+
+class ExportTestCase(RegistrationTestCase):
+    def setUp(self):
+        super(ExportTestCase, self).setUp()
+        self.login_admin()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        patcher = mock.patch.object(settings, 'EXPORT_ROOT', tmp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fake_table(self, ev, subjects, out_path):
+        with open(out_path, 'w') as fh:
+            fh.write('%i participants' % len(list(subjects)))
+        return out_path
+
+    def fake_renderer(self, **kwargs):
+        create_table = mock.Mock(**kwargs)
+        return create_table, mock.patch.dict(exports.RENDERERS, {'latex': (create_table, 'pdf')})
+
+    def download(self):
+        return self.client.get(reverse('events-participants', kwargs={'pk': self.ev.pk}))
+
+    def test_export(self):
+        self.create_subject()
+        create_table, renderer = self.fake_renderer(side_effect=self.fake_table)
+        with renderer:
+            response = self.download()
+            job = ExportJob.objects.get(event=self.ev)
+            self.assertRedirects(response, job.get_absolute_url(), fetch_redirect_response=False)
+            self.assertEqual(self.client.get(job.get_absolute_url(), {'format': 'json'}).json()['status'], 'pending')
+
+            exports.run(job.pk)
+            for i in range(2):
+                response = self.download()
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(b''.join(response.streaming_content), b'1 participants')
+            self.assertEqual(create_table.call_count, 1)
+
+            # a new registration changes the fingerprint
+            self.create_subject()
+            self.ev.refresh_from_db()
+            response = self.download()
+            self.assertEqual(response.status_code, 302)
+            new_job = ExportJob.objects.get(event=self.ev, status=ExportJob.PENDING)
+            exports.run(new_job.pk)
+            self.assertEqual(b''.join(self.download().streaming_content), b'2 participants')
+            self.assertFalse(ExportJob.objects.filter(pk=job.pk).exists())
+
+    def test_newer_jobs_kept(self):
+        self.create_subject()
+        now = timezone.now()
+        jobs = [ExportJob.objects.create(event=self.ev, fingerprint=str(i), status=status,
+                                         created=now - datetime.timedelta(minutes=10-i))
+                for i, status in enumerate([ExportJob.DONE, ExportJob.FAILED, ExportJob.PENDING, ExportJob.PENDING])]
+        for job in jobs[:2]:
+            self.fake_table(self.ev, [], job.file_path)
+        with self.fake_renderer(side_effect=self.fake_table)[1]:
+            exports.run(jobs[2].pk)
+        self.assertEqual(set(ExportJob.objects.values_list('pk', flat=True)), {jobs[2].pk, jobs[3].pk})
+        self.assertFalse(os.path.exists(jobs[0].file_path))
+        self.assertEqual(ExportJob.objects.get(pk=jobs[3].pk).status, ExportJob.PENDING)
+
+    def test_failed_export(self):
+        with self.fake_renderer(side_effect=RuntimeError('pdflatex failed'))[1]:
+            self.download()
+            job = ExportJob.objects.get(event=self.ev)
+            exports.run(job.pk)
+            response = self.client.get(job.get_absolute_url())
+            self.assertContains(response, 'pdflatex failed')
+
+    def test_html_export(self):
+        subj = self.create_subject()
+        Subject.objects.filter(pk=subj.pk).update(name='<b>Tom & Jerry</b>')
+        with mock.patch.object(settings, 'PARTICIPANT_LIST_RENDERER', 'html'):
+            self.download()
+            job = ExportJob.objects.get(event=self.ev)
+            exports.run(job.pk)
+            response = self.download()
+        self.assertTrue(response['Content-Type'].startswith('text/html'))
+        content = b''.join(response.streaming_content).decode()
+        self.assertIn('&lt;b&gt;Tom &amp; Jerry&lt;/b&gt;', content)
+        self.assertIn(subj.email, content)
+
+    def test_pdflatex_error(self):
+        self.create_subject()
+        out_path = os.path.join(settings.EXPORT_ROOT, 'list.pdf')
+        with mock.patch.object(settings, 'PDFLATEX', 'false'):
+            with self.assertRaisesRegex(TableBuildError, 'exit code 1'):
+                create_table(self.ev, Subject.objects.filter(event=self.ev), out_path)
+        with mock.patch.object(settings, 'PDFLATEX', 'no-such-pdflatex'):
+            with self.assertRaisesRegex(TableBuildError, 'unable to run pdflatex'):
+                create_table(self.ev, Subject.objects.filter(event=self.ev), out_path)
+        self.assertFalse(os.path.exists(out_path))
+
+
+class CsvExportTestCase(RegistrationTestCase):
+    def test_csv(self):
+        self.login_admin()
+        other = Event.objects.create(title='Other', num_total_seats=20)
+        subjects = [self.create_subject() for i in range(3)]
+        Subject.objects.create(name='Other', given_name='Other', email='other@test.com', event=other)
+
+        response = self.client.get(reverse('events-participants-csv', kwargs={'pk': self.ev.pk}))
+        self.assertTrue(response.streaming)
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0][:5], ['id', 'event', 'name', 'given_name', 'email'])
+        self.assertEqual(sorted(r[4] for r in rows[1:]), sorted(s.email for s in subjects))
+        self.assertEqual(rows[1][1], str(self.ev))
+
+        response = self.client.get(reverse('subjects-csv'))
+        self.assertEqual(len(b''.join(response.streaming_content).decode().splitlines()), 5)
+
+    def test_invalid_event(self):
+        self.login_admin()
+        response = self.client.get(reverse('subjects-csv'), {'event': self.ev.pk})
+        self.assertEqual(response.status_code, 200)
+        for event in ('', 'abc', '1.5', '\u00b2', '-1', '99999999999999999999999', str(self.ev.pk + 1)):
+            response = self.client.get(reverse('subjects-csv'), {'event': event})
+            self.assertEqual(response.status_code, 404)
+        response = self.client.get(reverse('events-participants-csv', kwargs={'pk': 'abc'}))
+        self.assertEqual(response.status_code, 404)
+
+
+class BouncingBackend(locmem.EmailBackend):
+    def send_messages(self, messages):
+        for message in messages:
+            if 'bounce' in message.to[0]:
+                raise smtplib.SMTPRecipientsRefused({message.to[0]: (550, b'unknown user')})
+        return super(BouncingBackend, self).send_messages(messages)
+
+
+class UnreachableBackend(locmem.EmailBackend):
+    def open(self):
+        raise ConnectionRefusedError('connection refused')
+
+
+class MailerTestCase(RegistrationTestCase):
+    @mock.patch.object(mailing, 'MAIL_BATCH_SIZE', 2)
+    @mock.patch.object(mailing, 'MAIL_MAX_ATTEMPTS', 2)
+    def test_batches(self):
+        subjects = [self.create_subject() for i in range(4)]
+        subjects[1].email = 'bounce@test.com'
+        subjects[1].save()
+
+        mailing.handle_new_subjects()
+        self.assertFalse(Subject.objects.filter(confirmation_request_sent=False).exists())
+        self.assertEqual(OutboxMessage.objects.filter(kind='confirmation_request').count(), 4)
+
+        with mock.patch.object(mailing, 'get_connection', side_effect=BouncingBackend) as get_connection:
+            self.assertTrue(mailing.drain_outbox())
+        # one connection per batch, the bounced mail doesn't stop the others
+        self.assertEqual(get_connection.call_count, 2)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         sorted(s.email for s in subjects if s is not subjects[1]))
+        bounced = OutboxMessage.objects.get(recipient='bounce@test.com')
+        self.assertEqual((bounced.status, bounced.attempts), (OutboxMessage.PENDING, 1))
+        self.assertIn('unknown user', bounced.last_error)
+        self.assertGreater(bounced.next_attempt, timezone.now() + datetime.timedelta(seconds=50))
+
+        # not due yet
+        with mock.patch.object(mailing, 'get_connection', side_effect=BouncingBackend) as get_connection:
+            self.assertTrue(mailing.drain_outbox())
+        self.assertEqual(get_connection.call_count, 0)
+
+        OutboxMessage.objects.filter(pk=bounced.pk).update(next_attempt=timezone.now())
+        with mock.patch.object(mailing, 'get_connection', side_effect=BouncingBackend):
+            self.assertTrue(mailing.drain_outbox())
+        bounced.refresh_from_db()
+        self.assertEqual((bounced.status, bounced.attempts), (OutboxMessage.DEAD, 2))
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_unreachable(self):
+        self.create_subject()
+        mailing.handle_new_subjects()
+        with mock.patch.object(mailing, 'get_connection', side_effect=UnreachableBackend):
+            self.assertFalse(mailing.drain_outbox())
+        # doesn't count as attempt
+        msg = OutboxMessage.objects.get()
+        self.assertEqual((msg.status, msg.attempts, msg.claimed_by), (OutboxMessage.PENDING, 0, ''))
+        # nor as sent mail of the rate limit
+        self.assertEqual(MailRelayBucket.objects.get(name='default').tokens, 1)
+
+        self.assertTrue(mailing.drain_outbox())
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_pending(self):
+        subjects = [self.create_subject() for i in range(4)]
+        # reminder due, cancellation due, nothing due, confirmed
+        hours = [13, 25, 1, 30]
+        for sub, h in zip(subjects, hours):
+            sub.confirmation_request_sent = True
+            sub.reminder_sent = h == 25
+            sub.status_confirmed = sub is subjects[3]
+            sub.reg_date = timezone.now() - datetime.timedelta(hours=h)
+            sub.save()
+
+        mailing.handle_pending_subjects()
+        self.assertTrue(mailing.drain_outbox())
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), sorted(s.email for s in subjects[:2]))
+        self.assertTrue(Subject.objects.get(pk=subjects[0].pk).reminder_sent)
+        self.assertFalse(Subject.objects.filter(pk=subjects[1].pk).exists())
+        self.assertFalse(Subject.objects.get(pk=subjects[2].pk).reminder_sent)
+        # the cancellation outlives the registration
+        self.assertEqual(OutboxMessage.objects.get(kind='cancellation').registration, None)
+        self.ev.refresh_from_db()
+        self.assertEqual(self.ev.seats_taken, 3)
+
+    def test_conditional_update(self):
+        sub = self.create_subject()
+        Subject.objects.filter(pk=sub.pk).update(
+            confirmation_request_sent=True, reminder_due_at=timezone.now() - datetime.timedelta(hours=1))
+
+        # the subject confirms right after it was claimed for the reminder
+        claim = mailing.claim
+        def confirm_after_claim(*args):
+            objs = claim(*args)
+            Subject.objects.filter(pk=sub.pk).update(status_confirmed=True)
+            return objs
+
+        with mock.patch.object(mailing, 'claim', side_effect=confirm_after_claim):
+            mailing.handle_pending_subjects()
+        sub = Subject.objects.get(pk=sub.pk)
+        self.assertTrue(sub.status_confirmed)
+        self.assertFalse(sub.reminder_sent)
+        self.assertEqual(sub.mail_claimed_by, '')
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_deadlines(self):
+        sub = self.create_subject()
+        self.assertEqual(sub.reminder_due_at, sub.reg_date + datetime.timedelta(hours=12))
+        self.assertEqual(sub.cancel_due_at, sub.reg_date + datetime.timedelta(hours=24))
+
+        self.ev.reminder_hours, self.ev.hold_back_hours = 1, 2
+        self.ev.save()
+        sub = Subject.objects.get(pk=sub.pk)
+        self.assertEqual(sub.reminder_due_at, sub.reg_date + datetime.timedelta(hours=1))
+        self.assertEqual(sub.cancel_due_at, sub.reg_date + datetime.timedelta(hours=2))
+
+    def test_pending_queries(self):
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                mailing.handle_pending_subjects()
+            return len(queries)
+
+        for i in range(2):
+            self.create_subject()
+        Subject.objects.update(confirmation_request_sent=True)
+        few = count_queries()
+        # pending registrations that are not due don't cost anything
+        for i in range(20):
+            self.create_subject()
+        Subject.objects.update(confirmation_request_sent=True)
+        self.assertEqual(count_queries(), few)
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_claims(self):
+        subjects = [self.create_subject() for i in range(3)]
+        Subject.objects.filter(pk=subjects[0].pk).update(
+            mail_claimed_by='other', mail_claimed_until=timezone.now() + datetime.timedelta(minutes=1))
+        # claim of a crashed worker
+        Subject.objects.filter(pk=subjects[1].pk).update(
+            mail_claimed_by='crashed', mail_claimed_until=timezone.now() - datetime.timedelta(minutes=1))
+
+        # saving a subject doesn't touch the claim
+        subjects[0].name = 'Changed'
+        subjects[0].save()
+
+        mailing.mailer()
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), sorted(s.email for s in subjects[1:]))
+        self.assertEqual(
+            list(Subject.objects.exclude(mail_claimed_by='').values_list('pk', 'mail_claimed_by')),
+            [(subjects[0].pk, 'other')])
+
+    def test_outbox_stats(self):
+        self.login_admin()
+        self.create_subject()
+        mailing.handle_new_subjects()
+        stats = self.client.get(reverse('outbox')).json()
+        self.assertEqual((stats['pending'], stats['sent'], stats['dead']), (1, 0, 0))
+        self.assertGreaterEqual(stats['oldest_pending_seconds'], 0)
+
+
+class ExpiryTestCase(RegistrationTestCase):
+    def test_expire(self):
+        self.ev.assigned_seats = True
+        self.ev.save()
+        subjects = [self.create_subject() for i in range(8)]
+        for i, sub in enumerate(subjects):
+            SeatAssignment.objects.create(event=self.ev, subject=sub, seat_number=i+1)
+        # the last one confirmed in time
+        Subject.objects.filter(pk__in=[s.pk for s in subjects]).update(
+            confirmation_request_sent=True, reminder_sent=True,
+            cancel_due_at=timezone.now() - datetime.timedelta(minutes=1))
+        confirmed = Subject.objects.get(pk=subjects[-1].pk)
+        confirmed.status_confirmed = True
+        confirmed.save()
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(expire_registrations(chunk_size=3), 7)
+        # the counters are updated once per chunk
+        self.assertEqual(len([q for q in queries if q['sql'].startswith('UPDATE "registration_event"')]), 3)
+
+        self.assertEqual(list(Subject.objects.values_list('pk', flat=True)), [subjects[-1].pk])
+        self.assertEqual(list(SeatAssignment.objects.values_list('seat_number', flat=True)), [8])
+        self.assertEqual(sorted(OutboxMessage.objects.filter(kind='cancellation').values_list('recipient', flat=True)),
+                         sorted(s.email for s in subjects[:-1]))
+        self.ev.refresh_from_db()
+        self.assertEqual((self.ev.seats_taken, self.ev.confirmed_seats), (1, 1))
+
+    def test_command(self):
+        sub = self.create_subject()
+        Subject.objects.filter(pk=sub.pk).update(
+            confirmation_request_sent=True, reminder_sent=True,
+            cancel_due_at=timezone.now() - datetime.timedelta(minutes=1))
+        out = StringIO()
+        call_command('expire_registrations', stdout=out)
+        self.assertIn('1 registration(s) expired', out.getvalue())
+        self.assertFalse(Subject.objects.exists())
+
+
+class MailTemplateTestCase(RegistrationTestCase):
+    def test_render(self):
+        self.ev.title = '100% Test'
+        self.ev.assigned_seats = True
+        self.ev.save()
+        sub = self.create_subject()
+        sub.num_seats = 2
+        sub.save()
+        for seat in (3, 4):
+            SeatAssignment.objects.create(event=self.ev, subject=sub, seat_number=seat)
+
+        message = mails.confirmation_request_message(sub)
+        self.assertEqual(message.subject, 'Registration for 100% Test')
+        self.assertEqual(message.body, 'mail_body_%(name)s_%(event)s_%(hold_back_hours)i_%(confirm_url)s' % dict(
+            name=sub.given_name, event=self.ev, hold_back_hours=24,
+            confirm_url=os.path.join(settings.BASE_URL, sub.token, 'confirm')))
+        self.assertEqual(message.to, [sub.email])
+        self.assertEqual(message.alternatives, [])
+
+        message = mails.confirmation_message(sub)
+        self.assertIn('subject_seats_pl_3,4', message.body)
+        self.assertIn(os.path.join(settings.BASE_URL, sub.token, 'modify'), message.body)
+
+    def test_cache(self):
+        mails._template.cache_clear()
+        subjects = [self.create_subject() for i in range(3)]
+        bodies = [mails.remainder_message(sub).body for sub in subjects]
+        self.assertEqual(mails._template.cache_info().misses, 1)
+        self.assertTrue(all(sub.given_name in body for sub, body in zip(subjects, bodies)))
+
+        # a change of the event is picked up
+        self.ev.hold_back_hours = 48
+        self.ev.save()
+        self.assertIn('_36_', mails.remainder_message(Subject.objects.get(pk=subjects[0].pk)).body)
+        self.assertEqual(mails._template.cache_info().misses, 2)
+
+    @mock.patch.object(settings, 'MAIL_HTML', True)
+    def test_html(self):
+        sub = self.create_subject()
+        sub.given_name = '<b>Bold</b>'
+        message = mails.confirmation_request_message(sub)
+        html, mimetype = message.alternatives[0]
+        self.assertEqual(mimetype, 'text/html')
+        self.assertIn('&lt;b&gt;Bold&lt;/b&gt;', html)
+        url = os.path.join(settings.BASE_URL, sub.token, 'confirm')
+        self.assertIn('<a href="%s">%s</a>' % (url, url), html)
+
+        email = mails.outbox_email(mails.outbox_message('confirmation_request', sub, message))
+        self.assertEqual(email.alternatives, message.alternatives)
+        self.assertEqual(email.body, message.body)
+
+
+class RateLimitTestCase(TestCase):
+    def test_bucket(self):
+        clock = FakeClock()
+        bucket = TokenBucket('test', rate=10, interval=60, burst=3, clock=clock.time)
+        self.assertEqual([bucket.take() for i in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.take(), 6)
+        clock.sleep(6)
+        self.assertEqual(bucket.take(), 0)
+
+        # the state is kept over a restart
+        bucket = TokenBucket('test', rate=10, interval=60, burst=3, clock=clock.time)
+        self.assertAlmostEqual(bucket.take(), 6)
+        clock.sleep(60)
+        self.assertEqual([bucket.take() for i in range(3)], [0, 0, 0])
+
+    def test_round_robin(self):
+        clock = FakeClock()
+        start = clock.now
+        pool = RelayPool([
+            {'name': 'a', 'rate': 1, 'interval': 10, 'burst': 1},
+            {'name': 'b', 'rate': 2, 'interval': 10, 'burst': 1, 'host': 'b.example.com'},
+        ], clock=clock.time, sleep=clock.sleep)
+        self.assertEqual([str(pool.acquire()) for i in range(4)], ['a', 'b', 'b', 'a'])
+        # 'b' gets its next token after 5 seconds, 'a' after 10
+        self.assertAlmostEqual(clock.now - start, 10)
+        self.assertEqual(pool.relays[1].options, {'host': 'b.example.com'})
+
+
+class SeatMapTestCase(SimpleTestCase):
+    def test_allocate_block(self):
+        seat_map = SeatMap(10, [1, 3, 4, 6])
+        self.assertEqual(seat_map.allocate(2), [7, 8])
+        self.assertEqual(seat_map.allocate(1), [2])
+        # no block of 3 seats left, fill the gaps
+        self.assertEqual(seat_map.allocate(3), [5, 9, 10])
+        self.assertEqual(seat_map.num_free, 0)
+        with self.assertRaises(ValidationError):
+            seat_map.allocate(1)
+
+    def test_reallocate(self):
+        seat_map = SeatMap(10, [1, 2, 3, 5])
+        self.assertEqual(seat_map.allocate(2, current=[2, 3]), [2, 3])
+        self.assertEqual(seat_map.allocate(1, current=[2, 3]), [2])
+        self.assertEqual(seat_map.num_free, 7)
+        self.assertEqual(seat_map.allocate(4, current=[2]), [6, 7, 8, 9])
+        with self.assertRaises(ValidationError):
+            seat_map.allocate(9, current=[6, 7, 8, 9])
+        # a failed allocation keeps the current seats
+        self.assertEqual(seat_map.num_free, 4)
+
+
+class BookingConcurrencyTestCase(TransactionTestCase):
+    def setUp(self):
+        self.ev = Event.objects.create(
+            title='Rush',
+            num_total_seats=25,
+            assigned_seats=True,
+            enable_on=timezone.now() - datetime.timedelta(days=1),
+            disable_on=timezone.now() + datetime.timedelta(days=1),
+        )
+
+    def register(self, i, results):
+        try:
+            response = Client().post(reverse('index'), data=dict(
+                name='Name%i' % i, given_name='Given', email='rush%i@test.com' % i,
+                event=self.ev.pk, num_seats=(i % 3)+1, privacy=True))
+            results[i] = response.status_code
+        finally:
+            connection.close()
+
+    def test_parallel_registrations(self):
+        n = 20
+        results = {}
+        threads = [threading.Thread(target=self.register, args=(i, results)) for i in range(n)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+
+        self.assertEqual(len(results), n)
+        self.assertTrue(all(code in (200, 302) for code in results.values()))
+        subs = Subject.objects.filter(event=self.ev)
+        seats = [s for sub in subs for s in sub.seat_numbers]
+        self.ev.refresh_from_db()
+        self.assertEqual(self.ev.seats_taken, sum(s.num_seats for s in subs))
+        self.assertLessEqual(self.ev.seats_taken, self.ev.num_total_seats)
+        self.assertEqual(len(seats), len(set(seats)))
+        self.assertEqual(len(seats), self.ev.seats_taken)
+
+
+class ConfirmConcurrencyTestCase(TransactionTestCase):
+    def setUp(self):
+        self.ev = Event.objects.create(title='Rush', num_total_seats=500)
+        self.subs = [Subject.objects.create(name='Name%i' % i, given_name='Given', email='rush%i@test.com' % i,
+                                            event=self.ev, num_seats=(i % 3)+1) for i in range(100)]
+
+    def confirm(self, subs, results):
+        try:
+            client = Client()
+            for sub in subs:
+                results[sub.pk] = client.get(reverse('subject-confirm', args=[sub.token])).status_code
+        finally:
+            connection.close()
+
+    def test_parallel_confirmations(self):
+        results = {}
+        threads = [threading.Thread(target=self.confirm, args=(self.subs[i::10], results)) for i in range(10)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+
+        self.assertEqual(list(results.values()), [200] * len(self.subs))
+        self.assertEqual(Subject.objects.filter(status_confirmed=True).count(), len(self.subs))
+        self.ev.refresh_from_db()
+        self.assertEqual(self.ev.confirmed_seats, sum(sub.num_seats for sub in self.subs))
+
+
+class MailerWorkersTestCase(TransactionTestCase):
+    def setUp(self):
+        self.ev = Event.objects.create(title='Mail', num_total_seats=100)
+        for i in range(30):
+            Subject.objects.create(name='Name%i' % i, given_name='Given', email='worker%i@test.com' % i, event=self.ev)
+
+    def work(self):
+        try:
+            mailing.mailer()
+        finally:
+            connection.close()
+
+    @mock.patch.object(mailing, 'MAIL_BATCH_SIZE', 4)
+    def test_parallel_workers(self):
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.object(mailing, 'MAIL_LOCK_FILE', os.path.join(tmp, 'mailing.lock')):
+            threads = [threading.Thread(target=self.work) for i in range(4)]
+            for t in threads: t.start()
+            for t in threads: t.join()
+
+        recipients = [m.to[0] for m in mail.outbox]
+        self.assertEqual(len(recipients), 30)
+        self.assertEqual(len(set(recipients)), 30)
+        self.assertFalse(Subject.objects.filter(confirmation_request_sent=False).exists())
+        self.assertFalse(Subject.objects.exclude(mail_claimed_by='').exists())
+
+    def register(self, n):
+        try:
+            for i in range(n):
+                Subject.objects.create(name='Name', given_name='Given', email='%i.%i@test.com' % (
+                    threading.get_ident(), i), event=self.ev)
+        finally:
+            connection.close()
+
+    def test_concurrent_registrations(self):
+        # the mailer waits for the registrations instead of failing on the locked database
+        threads = [threading.Thread(target=self.register, args=(20,)) for i in range(3)]
+        for t in threads: t.start()
+        try:
+            while any(t.is_alive() for t in threads):
+                mailing.mailer()
+        finally:
+            for t in threads: t.join()
+        mailing.mailer()
+        self.assertEqual(len(mail.outbox), 90)
+        self.assertFalse(Subject.objects.filter(confirmation_request_sent=False).exists())
+
+    def test_failed_cycle(self):
+        stop = threading.Event()
+        cycles = []
+
+        def mailer():
+            cycles.append(1)
+            if len(cycles) == 1:
+                raise OperationalError('database is locked')
+            stop.set()
+
+        with mock.patch.object(mailing, 'mailer', mailer), mock.patch.object(mailing.Waiter, 'wait'):
+            mailing.run(stop)
+        self.assertEqual(len(cycles), 2)
+
+
+class MailerWakeupTestCase(TransactionTestCase):
+    def setUp(self):
+        self.ev = Event.objects.create(
+            title='Wakeup',
+            num_total_seats=20,
+            enable_on=timezone.now() - datetime.timedelta(days=1),
+            disable_on=timezone.now() + datetime.timedelta(days=1),
+        )
+
+    def test_latency(self):
+        cycles = []
+        idle = threading.Event()
+        stop = threading.Event()
+        mailer = mailing.mailer
+
+        def cycle():
+            mailer()
+            cycles.append(time.monotonic())
+            idle.set()
+
+        def run():
+            try:
+                mailing.run(stop)
+            finally:
+                connection.close()
+
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.object(settings, 'MAIL_WAKEUP_FILE', os.path.join(tmp, 'wakeup')), \
+                mock.patch.object(settings, 'MAIL_POLL_MIN', 30), \
+                mock.patch.object(mailing, 'mailer', side_effect=cycle):
+            thread = threading.Thread(target=run)
+            thread.start()
+            try:
+                self.assertTrue(idle.wait(5))
+                start = time.monotonic()
+                response = self.client.post(reverse('index'), data=dict(
+                    name='Name', given_name='Given', email='wakeup@test.com',
+                    event=self.ev.pk, num_seats=1, privacy=True))
+                self.assertEqual(response.status_code, 302)
+                while not mail.outbox and time.monotonic() - start < 10:
+                    time.sleep(0.01)
+                latency = time.monotonic() - start
+            finally:
+                stop.set()
+                wakeup._notify()
+                thread.join()
+
+        self.assertEqual([m.to[0] for m in mail.outbox], ['wakeup@test.com'])
+        # without the wake up, the mail would be sent after MAIL_POLL_MIN
+        self.assertLess(latency, 2, 'registration to mail took %.3f s' % latency)
+        # the first one and the one woken up by the registration
+        self.assertEqual(len(cycles), 2)
+
+
+class FakeSMTPServer(object):
+    """
+        Minimal smtp server on localhost, running in its own thread. Keeps the recipients of the
+        received mails and the highest number of sessions at the same time.
+    """
+    def __init__(self, delay=0.05):
+        # seconds each mail takes
+        self.delay = delay
+        self.recipients = []
+        self.sessions = self.max_sessions = 0
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+
+    def __enter__(self):
+        self.thread.start()
+        self.server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self.session, '127.0.0.1', 0), self.loop).result()
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    def __exit__(self, *args):
+        self.loop.call_soon_threadsafe(self.server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def session(self, reader, writer):
+        self.sessions += 1
+        self.max_sessions = max(self.sessions, self.max_sessions)
+        recipients = []
+        try:
+            writer.write(b'220 localhost fake smtp\r\n')
+            while True:
+                line = (await reader.readline()).decode()
+                command = line[:4].upper()
+                if not line or command == 'QUIT':
+                    writer.write(b'221 bye\r\n')
+                    break
+                if command == 'RCPT':
+                    address = line[line.index('<')+1:line.index('>')]
+                    if 'bounce' in address:
+                        writer.write(b'550 unknown user\r\n')
+                    else:
+                        recipients.append(address)
+                        writer.write(b'250 ok\r\n')
+                elif command == 'DATA':
+                    writer.write(b'354 go ahead\r\n')
+                    while (await reader.readline()).rstrip() != b'.':
+                        pass
+                    await asyncio.sleep(self.delay)
+                    self.recipients += recipients
+                    recipients = []
+                    writer.write(b'250 ok\r\n')
+                else:
+                    recipients = [] if command == 'RSET' else recipients
+                    writer.write(b'250 ok\r\n')
+                await writer.drain()
+        finally:
+            self.sessions -= 1
+            writer.close()
+
+
+class AsyncMailerTestCase(TransactionTestCase):
+    def setUp(self):
+        self.ev = Event.objects.create(title='Async', num_total_seats=100)
+        for i in range(12):
+            Subject.objects.create(name='Name%i' % i, given_name='Given', event=self.ev,
+                                   email='bounce@test.com' if i == 5 else 'async%i@test.com' % i)
+        mailing.enqueue_due_mails()
+
+    def relays(self, server, **limit):
+        relay = dict(name='fake', rate=1000, interval=1, burst=1000)
+        relay.update(limit, backend='django.core.mail.backends.smtp.EmailBackend', host='127.0.0.1', port=server.port)
+        return RelayPool([relay])
+
+    def drain(self, sessions):
+        async def drain():
+            try:
+                return await mailing.drain_outbox_async(sessions)
+            finally:
+                await sync_to_async(lambda: connection.close())()
+        return asyncio.run(drain())
+
+    def test_sessions(self):
+        with FakeSMTPServer() as server, mock.patch.object(mailing, 'relays', self.relays(server)):
+            self.assertTrue(self.drain(sessions=4))
+
+        self.assertEqual(sorted(server.recipients), sorted('async%i@test.com' % i for i in range(12) if i != 5))
+        self.assertEqual(server.max_sessions, 4)
+        self.assertEqual(OutboxMessage.objects.filter(status=OutboxMessage.SENT).count(), 11)
+        bounced = OutboxMessage.objects.get(recipient='bounce@test.com')
+        self.assertEqual((bounced.status, bounced.attempts), (OutboxMessage.PENDING, 1))
+
+    def test_rate_limit(self):
+        # 12 mails, the first right away and then 20 per second, shared by all sessions
+        with FakeSMTPServer(delay=0) as server, \
+                mock.patch.object(mailing, 'relays', self.relays(server, rate=20, burst=1)):
+            start = time.monotonic()
+            self.drain(sessions=4)
+            duration = time.monotonic() - start
+        self.assertEqual(len(server.recipients), 11)
+        self.assertGreaterEqual(duration, 0.5)
+
+    def test_unreachable(self):
+        with FakeSMTPServer() as server:
+            relays = self.relays(server, rate=1, interval=3600, burst=10)
+        with mock.patch.object(mailing, 'relays', relays):
+            self.assertFalse(self.drain(sessions=4))
+        self.assertFalse(OutboxMessage.objects.exclude(attempts=0).exists())
+        self.assertFalse(OutboxMessage.objects.exclude(claimed_by='').exists())
+        # the tokens of the failed connections are given back
+        self.assertGreater(MailRelayBucket.objects.get(name='fake').tokens, 9)
+
+    def test_locked(self):
+        # another worker holds the lock, the event loop isn't blocked while waiting for it
+        locked, release = threading.Event(), threading.Event()
+
+        def other_worker():
+            with mailing.worker_lock():
+                locked.set()
+                # not forever, a blocked event loop never sets it
+                release.wait(5)
+
+        async def main():
+            task = asyncio.ensure_future(mailing.mailer_async())
+            start = time.monotonic()
+            for i in range(5):
+                await asyncio.sleep(.01)
+            self.assertLess(time.monotonic() - start, 1)
+            self.assertFalse(task.done())
+            release.set()
+            try:
+                await task
+            finally:
+                await sync_to_async(lambda: connection.close())()
+
+        worker = threading.Thread(target=other_worker)
+        worker.start()
+        locked.wait()
+        with FakeSMTPServer() as server, mock.patch.object(mailing, 'relays', self.relays(server)):
+            asyncio.run(main())
+        worker.join()
+        self.assertEqual(len(server.recipients), 11)